@@ -1,6 +1,8 @@
 from secrets_folder.secrets_file import ttn_apikey, TTN_URL
 from datetime import datetime, timezone
 import matplotlib.pyplot as plt
+import numpy as np
+import message_store
 import time_mapping
 import ttn_data
 import time
@@ -64,35 +66,39 @@ def get_last_battery_voltage(connection):
                     battery_voltage = last_message["decoded_payload"]["analog_in_8"]
                     return battery_voltage
 
-def get_range_battery_levels(connection, begin, end):
+def get_battery_levels(messages):
     """
-    Retrieve battery voltage levels for a specific time range from the TTN data source.
+    Extract the battery voltage levels of a columnar slice of messages.
     Inputs:
-    - connection: Dictionary containing server URL and headers
-    - start_time: Start time of the range as a string in the format "YYYY-MM-DDTHH:MM:SS.SSSSSSZ"
-    - end_time: End time of the range as a string in the format "YYYY-MM-DDTHH:MM:SS.SSSSSSZ"
+    - messages: Columnar message data, e.g. a time range slice (see ttn_data.get_time_ranges_messages).
+    Outputs:
+    - Returns a list of tuples (seconds since the first message, voltage).
+    """
+    battery_level = []
+    received_at = messages["received_at"]
+    if len(received_at) > 0:
+        print(datetime.fromtimestamp(received_at[0] / 1e6, tz=timezone.utc))
+        if "analog_in_8" in messages["payload"]:
+            battery_voltages = messages["payload"]["analog_in_8"]
+            # Seconds elapsed since the first message of the range
+            seconds = (received_at - received_at[0]) / 1e6
+            measured = ~np.isnan(battery_voltages)
+            battery_level = list(zip(seconds[measured].tolist(), battery_voltages[measured].tolist()))
+    return battery_level
+
+def get_range_battery_levels(columnar, begin, end):
+    """
+    Retrieve battery voltage levels for a specific time range of the stored messages.
+    Inputs:
+    - columnar: Columnar message data, loaded once (see message_store.get_columnar_data).
+    - begin: Start time of the range as a string in the format "YYYY-MM-DDTHH:MM:SS.SSSSSSZ"
+    - end: End time of the range as a string in the format "YYYY-MM-DDTHH:MM:SS.SSSSSSZ"
     Outputs:
     - Returns a list of tuples (time, voltage) for the specified time range.
     """
     begin = datetime.strptime(begin,"%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
     end = datetime.strptime(end,"%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
-    battery_level = []
-    json_data = ttn_data.fetch_data(connection["url"], connection["headers"])
-    if json_data:
-        parsed_data = ttn_data.parse_json_data(json_data)
-        begin_end_messages = ttn_data.get_time_range_messages(parsed_data, begin, end)
-        if len(begin_end_messages) > 0:
-            message = begin_end_messages[0]
-            begin_time = datetime.strptime(message["received_at"],"%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
-            print(begin_time)
-        for message in begin_end_messages:
-            if "decoded_payload" in message.keys():
-                if "analog_in_8" in message["decoded_payload"].keys():
-                    battery_voltage = message["decoded_payload"]["analog_in_8"]
-                    received_at = datetime.strptime(message["received_at"],"%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
-                    seconds = (received_at - begin_time).total_seconds()
-                    battery_level.append((seconds,battery_voltage))
-    return battery_level
+    return get_battery_levels(ttn_data.get_time_range_messages(columnar, begin, end))
 
 def main():
     """
@@ -125,10 +131,12 @@ def main():
         plot_battery_level(battery_level) 
     elif command == 'r':
         time_map = time_mapping.time_map()
-        for time_range in time_map:
-            (begin, end) = time_range["time_tuple"]
-            battery_level = get_range_battery_levels(connection, begin.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), end.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
-            #battery_level = get_range_battery_levels(connection, "2024-06-10T10:27:00.000000Z", "2024-06-10T11:27:00.000000Z")
+        # The history is loaded and indexed once, every time range is a binary search slice of it
+        columnar = message_store.get_columnar_data(connection)
+        ranges_messages = ttn_data.get_time_ranges_messages(columnar, [time_range["time_tuple"] for time_range in time_map])
+        for begin_end_messages in ranges_messages:
+            battery_level = get_battery_levels(begin_end_messages)
+            #battery_level = get_range_battery_levels(columnar, "2024-06-10T10:27:00.000000Z", "2024-06-10T11:27:00.000000Z")
             plot_battery_level(battery_level)
     else:
         print("Unknown command. Exit.")
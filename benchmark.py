@@ -2,13 +2,24 @@
 from secrets_folder.parsed_data_recorrido import parsed_data_stored
 
 from secrets_folder.secrets_file import ttn_apikey, TTN_URL
+from maps.disca_coordinates import disca_coord
 import matplotlib.pyplot as plt
-from maps.disca_map import rss_map, RSS_NULL
-from locate import least_squares_classification
+import fingerprint
+import message_store
 import ttn_data
 import time_mapping
+import numpy as np
+import multiprocessing
 import random
-import copy
+import math
+import time
+
+# Iterations of every benchmark, each one with its own random test sets
+BENCHMARK_RUNS = 30
+# RSS_NULL search range (begin, end, step)
+RSS_NULL_SEARCH = (0, -400, -1)
+# Data shared with the benchmark worker processes, set once per worker (see _init_worker)
+_worker_data = {}
 
 def plot_benchmark_accuracy(benchmark_results):
     """
@@ -34,23 +45,35 @@ def plot_benchmark_accuracy(benchmark_results):
     plt.grid(True)
     plt.show()
 
-def generate_test_set(messages, test_qty):
+def _messages_receptions(messages):
+    """
+    Get the channel and the (gateway, RSSI) receptions of every message of a list or of a columnar slice.
+    """
+    if not ttn_data.is_columnar(messages):
+        return [(message["channel"], [(rx_meta["gateway_id"], rx_meta["rssi"]) for rx_meta in message["rx_metadata"]]) for message in messages]
+    bounds = np.searchsorted(messages["rx_msg"], messages["msg_start"] + np.arange(len(messages["channel"]) + 1)).tolist()
+    gateways = [messages["gateways"][g] for g in messages["rx_gateway"].tolist()]
+    rssi = messages["rx_rssi"].tolist()
+    channels = [None if channel < 0 else channel for channel in messages["channel"].tolist()]
+    return [(channel, list(zip(gateways[bounds[m]:bounds[m + 1]], rssi[bounds[m]:bounds[m + 1]]))) for m, channel in enumerate(channels)]
+
+def generate_test_set(messages, test_qty, rng=random):
     """
     Generate a test set by randomly distributing messages among a specified number of tests.
     Inputs:
-    - messages: List of message dictionaries containing channel and rx_metadata.
+    - messages: List of message dictionaries containing channel and rx_metadata, or a columnar slice of messages
+      (see ttn_data.to_columnar).
     - test_qty: Number of test sets to generate.
+    - rng: Random number generator (random.Random) used for the distribution, the global one by default.
     Outputs:
     - Returns a list of test sets with RSSI values organized by gateway and channel.
     """
-    random.shuffle(messages)
+    messages = _messages_receptions(messages)
+    rng.shuffle(messages)
     test_set = [{} for _ in range(test_qty)]
-    for message in messages:
-        rnd_test = random.randint(0, test_qty - 1)
-        channel = message["channel"] 
-        for gateway in message["rx_metadata"]:
-            gateway_id = gateway["gateway_id"]
-            rssi = gateway["rssi"]
+    for channel, receptions in messages:
+        rnd_test = rng.randint(0, test_qty - 1)
+        for gateway_id, rssi in receptions:
             if gateway_id not in test_set[rnd_test]:
                 test_set[rnd_test][gateway_id] = {}
             if channel in test_set[rnd_test][gateway_id]:
@@ -59,111 +82,307 @@ def generate_test_set(messages, test_qty):
                 test_set[rnd_test][gateway_id][channel] = rssi
     return test_set
 
-def generate_benchmark_tests(parsed_data, time_map, test_qty):
+def generate_benchmark_tests(parsed_data, time_map, test_qty, rng=random):
     """
     Create benchmark test sets from parsed data and a time map.
     Inputs:
-    - parsed_data: Parsed data from the TTN data source.
+    - parsed_data: Parsed data from the TTN data source, preferably columnar (see ttn_data.to_columnar) so the places
+      are sliced without copying the messages.
     - time_map: List of time range mappings with associated place names.
     - test_qty: Number of test sets to generate for each place.
+    - rng: Random number generator (random.Random) used to build the tests, the global one by default.
     Outputs:
     - Returns a dictionary of benchmark test sets organized by place name.
     """
     benckmark_tests = {}
-    for place in time_map:
-        (begin, end) = place["time_tuple"]
+    places_messages = ttn_data.get_time_ranges_messages(parsed_data, [place["time_tuple"] for place in time_map])
+    for place, begin_end_messages in zip(time_map, places_messages):
         place_name = place["place_name"]
-        begin_end_messages = ttn_data.get_time_range_messages(parsed_data, begin, end)
-        test_set = generate_test_set(begin_end_messages, test_qty)
+        test_set = generate_test_set(begin_end_messages, test_qty, rng)
         benckmark_tests[place_name] = test_set
     return benckmark_tests
 
-def run_benchmark(benckmark_tests, rss_map, RSS_NULL):
+def _flatten_tests(benckmark_tests):
     """
-    Run benchmark tests to evaluate the classification accuracy.
-    Inputs:
-    - benckmark_tests: Dictionary of test sets organized by place name.
-    - rss_map: RSS map for classification.
-    - RSS_NULL: Default RSSI null value for missing data.
-    Outputs:
-    - Returns a dictionary with overall, zone, and floor accuracy percentages.
+    Get the expected place and the observation of every non empty test, in order.
     """
-    available_gateways = ["rak7248-grc-pm65","main-gtw-grc","itaca-upv-022"]
-    benchmark_total = 0
-    benchmark_correct = 0
-    benchmark_correct_zone = 0
-    benchmark_correct_floor = 0
+    expected_places = []
+    tests = []
     for place_name in benckmark_tests.keys():
-        test_total = 0
-        test_correct = 0
-        test_correct_zone = 0
-        test_correct_floor = 0
         for test in benckmark_tests[place_name]:
             # Check if test is not empty
             if test:
-                test_total += 1
-                classification, error_scores = least_squares_classification(rss_map, RSS_NULL, available_gateways, test, 0)
-                if place_name == classification:
-                    test_correct += 1
-                if place_name[1] == classification[1]:
-                    test_correct_zone += 1
-                if place_name[0] == classification[0]:
-                    test_correct_floor += 1
-                #print(f"Expected {place_name}, result {classification}")
-        benchmark_total += test_total
-        benchmark_correct += test_correct
-        benchmark_correct_zone += test_correct_zone
-        benchmark_correct_floor += test_correct_floor
-        #print(f"Accuracy: {100 * test_correct/test_total}%")
+                expected_places.append(place_name)
+                tests.append(test)
+    return expected_places, tests
+
+def _accuracy_result(expected_places, classifications):
+    """
+    Get the overall, zone and floor accuracy of a list of classifications (see run_benchmark).
+    """
+    benchmark_total = len(expected_places)
+    benchmark_correct = 0
+    benchmark_correct_zone = 0
+    benchmark_correct_floor = 0
+    for place_name, classification in zip(expected_places, classifications):
+        if place_name == classification:
+            benchmark_correct += 1
+        if place_name[1] == classification[1]:
+            benchmark_correct_zone += 1
+        if place_name[0] == classification[0]:
+            benchmark_correct_floor += 1
     benchmark_result = {
         "accuracy": benchmark_correct/benchmark_total,
         "zone_accuracy": benchmark_correct_zone/benchmark_total,
         "floor_accuracy": benchmark_correct_floor/benchmark_total,
+        "expected_places": expected_places,
+        "classifications": list(classifications)
     }
+    return benchmark_result
+
+def run_benchmark(benckmark_tests, fingerprint_map):
+    """
+    Run benchmark tests to evaluate the classification accuracy.
+    Inputs:
+    - benckmark_tests: Dictionary of test sets organized by place name.
+    - fingerprint_map: Fingerprint of the RSS map used for classification (see fingerprint.load_fingerprint).
+    Outputs:
+    - Returns a dictionary with overall, zone, and floor accuracy percentages, and the expected and classified place of every test.
+    """
+    expected_places, tests = _flatten_tests(benckmark_tests)
+    # Classify all the tests in a single batch
+    obs_values, obs_mask = fingerprint.pack_observations(fingerprint_map, tests, 0)
+    classifications, error_scores = fingerprint.classify_observations(fingerprint_map, obs_values, obs_mask)
+    benchmark_result = _accuracy_result(expected_places, classifications)
     #print("Benchmark run:")
     #print(f"Benchmark accuracy: {100 * benchmark_correct/benchmark_total}%")
     #print(f"Benchmark zone accuracy: {100 * benchmark_correct_zone/benchmark_total}%")
     #print(f"Benchmark floor accuracy: {100 * benchmark_correct_floor/benchmark_total}%")
     return benchmark_result
+
+def run_classifiers_benchmark(benckmark_tests, fingerprint_map, classifiers=None, k=3, positions=None):
+    """
+    Evaluate several classifiers (see fingerprint.CLASSIFIERS) on the same tests, scoring the tests only once.
+    Inputs:
+    - benckmark_tests: Dictionary of test sets organized by place name.
+    - fingerprint_map: Fingerprint of the RSS map used for classification (see fingerprint.load_fingerprint).
+    - classifiers: List of classifier names, all the ones that can run by default (see fingerprint.default_classifiers).
+    - k: Number of most probable places considered for the top-k accuracy.
+    - positions: Optional positions of the places (see fingerprint.place_positions), required by the k-NN classifier.
+    Outputs:
+    - Returns a dictionary with the run_benchmark result of every classifier, extended with the top-k accuracy, the mean
+      probability given to the classified place, the classification time per test (ms, including the shared scoring)
+      and, with the positions, the mean distance (m) between the classified and the expected places.
+    """
+    expected_places, tests = _flatten_tests(benckmark_tests)
+    obs_values, obs_mask = fingerprint.pack_observations(fingerprint_map, tests, 0)
+    start = time.perf_counter()
+    scores = fingerprint.score_classifiers(fingerprint_map, obs_values, obs_mask, positions=positions)
+    scoring_time = time.perf_counter() - start
+    k = min(k, len(fingerprint_map["places"]))
+    results = {}
+    for name in classifiers or fingerprint.default_classifiers(positions):
+        start = time.perf_counter()
+        probabilities = fingerprint.CLASSIFIERS[name](scores)
+        top = np.argsort(-probabilities, axis=1, kind="stable")[:, :k]
+        classifier_time = time.perf_counter() - start
+        top_places = [[fingerprint_map["places"][p] for p in row] for row in top]
+        results[name] = _accuracy_result(expected_places, [row[0] for row in top_places])
+        results[name]["top_k_accuracy"] = float(np.mean([place_name in row for place_name, row in zip(expected_places, top_places)]))
+        results[name]["confidence"] = float(np.take_along_axis(probabilities, top[:, :1], axis=1).mean())
+        results[name]["ms_per_test"] = 1000 * (scoring_time + classifier_time) / len(tests)
+        if positions is not None:
+            # Distance between the classified and the expected place, where the k-NN position estimate pays off
+            place_index = {place: p for p, place in enumerate(fingerprint_map["places"])}
+            expected = positions[[place_index[place_name] for place_name in expected_places]]
+            errors = np.linalg.norm(positions[top[:, 0]] - expected, axis=1)
+            errors = errors[~np.isnan(errors)]
+            results[name]["position_error"] = float(errors.mean()) if len(errors) else math.nan
+    return results
             
-def get_best_rss_null(rss_begin, rss_end, rss_step, benckmark_tests, rss_map, RSS_NULL):
+def run_hierarchical_benchmark(benckmark_tests, fingerprint_map, floor_beam=fingerprint.HIERARCHY_FLOOR_BEAM,
+                               zone_beam=fingerprint.HIERARCHY_ZONE_BEAM):
+    """
+    Compare the hierarchical floor, zone and place search (see fingerprint.classify_hierarchical) with the exhaustive one.
+    Inputs:
+    - benckmark_tests: Dictionary of test sets organized by place name.
+    - fingerprint_map: Fingerprint of the RSS map used for classification (see fingerprint.load_fingerprint).
+    - floor_beam: Number of candidate floors kept.
+    - zone_beam: Number of candidate zones kept.
+    Outputs:
+    - Returns a dictionary with the run_benchmark result of the "exhaustive", "hierarchical" (exact) and "beam" (only
+      the candidate zones scored) searches, extended with the classification time per test (ms). The hierarchical and
+      beam results also have the fraction of tests classified as the exhaustive search ("agreement") and the mean
+      fraction of places scored ("scored_places").
+    """
+    expected_places, tests = _flatten_tests(benckmark_tests)
+    obs_values, obs_mask = fingerprint.pack_observations(fingerprint_map, tests, 0)
+    start = time.perf_counter()
+    exhaustive, _ = fingerprint.classify_observations(fingerprint_map, obs_values, obs_mask)
+    exhaustive_time = time.perf_counter() - start
+    results = {"exhaustive": _accuracy_result(expected_places, exhaustive)}
+    results["exhaustive"]["ms_per_test"] = 1000 * exhaustive_time / len(tests)
+    # The hierarchy is built once per map, like the fingerprint
+    hierarchy = fingerprint.build_hierarchy(fingerprint_map)
+    for name, exact in [("hierarchical", True), ("beam", False)]:
+        start = time.perf_counter()
+        places, error_scores = fingerprint.classify_hierarchical(fingerprint_map, obs_values, obs_mask, hierarchy,
+                                                                 floor_beam, zone_beam, exact=exact)
+        elapsed = time.perf_counter() - start
+        results[name] = _accuracy_result(expected_places, places)
+        results[name]["ms_per_test"] = 1000 * elapsed / len(tests)
+        results[name]["agreement"] = float(np.mean([a == b for a, b in zip(exhaustive, places)]))
+        results[name]["scored_places"] = float(np.isfinite(error_scores).mean())
+    return results
+
+def get_best_rss_null(rss_begin, rss_end, rss_step, benckmark_tests, fingerprint_map, refine_step=None):
     """
     Determine the best RSS_NULL value by testing a range of values and selecting the one with the highest accuracy.
+    All the values are evaluated in a single pass (see fingerprint.sweep_rss_null), without copying the map or the tests.
     Inputs:
     - rss_begin: Starting value for RSS_NULL.
     - rss_end: Ending value for RSS_NULL.
-    - rss_step: Step size for iterating through RSS_NULL values.
+    - rss_step: Step size for iterating through RSS_NULL values (can be fractional).
     - benckmark_tests: Dictionary of test sets organized by place name.
-    - rss_map: RSS map for classification.
-    - RSS_NULL: Default RSSI null value for missing data.
+    - fingerprint_map: Fingerprint of the RSS map used for classification (see fingerprint.load_fingerprint).
+    - refine_step: Optional finer step used to search again around the best value (e.g. 0.1 for sub-dB).
     Outputs:
     - Returns the best RSS_NULL value and its associated accuracy.
     """
-    rss_null_positions = []
-    # Find all RSS_NULL inside rss_map
-    for place, gateways in rss_map.items():
-        for gateway, rss_values in gateways.items():
-            for ch, rss in rss_values.items():
-                if rss == RSS_NULL:
-                    rss_null_positions.append((place,gateway,ch))
+    expected_places = []
+    tests = []
+    for place_name in benckmark_tests.keys():
+        for test in benckmark_tests[place_name]:
+            if test:
+                expected_places.append(fingerprint_map["places"].index(place_name) if place_name in fingerprint_map["places"] else -1)
+                tests.append(test)
+    obs_values, obs_mask = fingerprint.pack_observations(fingerprint_map, tests, 0)
+    expected_places = np.array(expected_places)
     # Test all RSS_NULL values
-    benchmark_results = []
-    for rss_null_value in range(rss_begin, rss_end, rss_step):
-        # Change all RSS_NULL in map
-        rss_map_new = copy.deepcopy(rss_map)
-        for (place,gateway,ch) in rss_null_positions:
-            rss_map_new[place][gateway][ch] = rss_null_value
-        # Run benchmark using new RSS_NULL value
-        benchmark_result = run_benchmark(copy.deepcopy(benckmark_tests), rss_map_new, rss_null_value)
-        benchmark_results.append((rss_null_value, benchmark_result["accuracy"]))
-    # Get best RSS_NULL
-    best_result = max(benchmark_results, key=lambda x: x[1])
+    rss_null_values = np.arange(rss_begin, rss_end, rss_step)
+    best_places = fingerprint.sweep_rss_null(fingerprint_map, obs_values, obs_mask, rss_null_values)
+    accuracies = np.mean(best_places == expected_places, axis=1)
+    best = int(np.argmax(accuracies))
+    best_result = (rss_null_values[best].item(), accuracies[best].item())
+    # Search again around the best value using the finer step
+    if refine_step:
+        rss_null_values = np.round(np.arange(best_result[0] - rss_step, best_result[0] + rss_step, math.copysign(refine_step, rss_step)), 6)
+        best_places = fingerprint.sweep_rss_null(fingerprint_map, obs_values, obs_mask, rss_null_values)
+        accuracies = np.mean(best_places == expected_places, axis=1)
+        best = int(np.argmax(accuracies))
+        if accuracies[best] > best_result[1]:
+            best_result = (rss_null_values[best].item(), accuracies[best].item())
     return best_result
 
+def _init_worker(parsed_data, time_map, map_path, available_gateways):
+    """
+    Set the data shared by all the tasks of a benchmark worker process (pool initializer).
+    """
+    _worker_data["parsed_data"] = parsed_data
+    _worker_data["time_map"] = time_map
+    # Every worker memory maps the same map file instead of receiving a copy
+    _worker_data["fingerprint_map"] = fingerprint.load_fingerprint(map_path, available_gateways)
+    _worker_data["positions"] = fingerprint.place_positions(_worker_data["fingerprint_map"]["places"], disca_coord)
+
+def _run_task(task):
+    """
+    Run one benchmark iteration with its own seeded test sets (pool task).
+    """
+    benchmark, seed, test_qty, refine_step = task
+    benckmark_tests = generate_benchmark_tests(_worker_data["parsed_data"], _worker_data["time_map"], test_qty, random.Random(seed))
+    if benchmark == "rss_null":
+        return get_best_rss_null(*RSS_NULL_SEARCH, benckmark_tests, _worker_data["fingerprint_map"], refine_step)
+    if benchmark == "classifiers":
+        return run_classifiers_benchmark(benckmark_tests, _worker_data["fingerprint_map"], positions=_worker_data["positions"])
+    if benchmark == "hierarchical":
+        return run_hierarchical_benchmark(benckmark_tests, _worker_data["fingerprint_map"])
+    return run_benchmark(benckmark_tests, _worker_data["fingerprint_map"])
+
+def run_parallel_benchmark(benchmark, parsed_data, time_map, available_gateways, runs=BENCHMARK_RUNS, test_qty=5, seed=None,
+                           processes=None, refine_step=None, map_path=fingerprint.MAP_FILE_PATH):
+    """
+    Run the iterations of a benchmark in a pool of processes.
+    Every iteration gets its own seed derived from the master seed, so the results do not depend on the number of
+    processes or on the order the iterations are run. The parsed data and the time map are sent once to every worker.
+    Inputs:
+    - benchmark: "rss_null" to search the best RSS_NULL value (see get_best_rss_null), "accuracy" (see run_benchmark),
+      "classifiers" to compare all the classifiers (see run_classifiers_benchmark) or "hierarchical" to compare the
+      hierarchical and the exhaustive search (see run_hierarchical_benchmark).
+    - parsed_data: Parsed data from the TTN data source, preferably columnar (see ttn_data.to_columnar).
+    - time_map: List of time range mappings with associated place names.
+    - available_gateways: List of gateways available for the classification.
+    - runs: Number of iterations.
+    - test_qty: Number of test sets to generate for each place.
+    - seed: Master seed (integer), a random one is used when None.
+    - processes: Number of worker processes, one per core by default.
+    - refine_step: Optional finer step of the RSS_NULL search.
+    - map_path: Path of the binary map file.
+    Outputs:
+    - Returns the master seed and the list of iteration results, in order.
+    """
+    seed_sequence = np.random.SeedSequence(seed)
+    tasks = [(benchmark, int(child.generate_state(1)[0]), test_qty, refine_step) for child in seed_sequence.spawn(runs)]
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(parsed_data, time_map, map_path, available_gateways)) as pool:
+        return seed_sequence.entropy, pool.map(_run_task, tasks)
+
+def _mean_ci(values):
+    """
+    Get the mean and the half width of its 95% confidence interval.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2:
+        return values.mean().item(), 0.0
+    return values.mean().item(), (1.96 * values.std(ddof=1) / math.sqrt(len(values))).item()
+
+def summarize_benchmark(benchmark_results, places):
+    """
+    Aggregate the results of several benchmark runs.
+    Inputs:
+    - benchmark_results: List of dictionaries returned by run_benchmark.
+    - places: List of place names of the map.
+    Outputs:
+    - Returns a dictionary with the mean and 95% confidence interval half width of every accuracy, the place names,
+      the confusion matrix (expected place x classified place) and the accuracy of every place.
+    """
+    summary = {key: _mean_ci([run[key] for run in benchmark_results]) for key in ["accuracy", "zone_accuracy", "floor_accuracy"]}
+    places = list(places)
+    for run in benchmark_results:
+        for place_name in run["expected_places"]:
+            if place_name not in places:
+                places.append(place_name)
+    place_index = {place_name: p for p, place_name in enumerate(places)}
+    confusion = np.zeros((len(places), len(places)), dtype=int)
+    for run in benchmark_results:
+        np.add.at(confusion, ([place_index[place_name] for place_name in run["expected_places"]],
+                              [place_index[place_name] for place_name in run["classifications"]]), 1)
+    tests = confusion.sum(axis=1)
+    summary["places"] = places
+    summary["confusion"] = confusion
+    summary["place_accuracy"] = {place_name: (confusion[p, p] / tests[p]).item() for p, place_name in enumerate(places) if tests[p]}
+    return summary
+
+def print_benchmark_summary(summary):
+    """
+    Print the aggregated benchmark results (see summarize_benchmark).
+    Inputs:
+    - summary: Dictionary returned by summarize_benchmark.
+    """
+    for key in ["accuracy", "zone_accuracy", "floor_accuracy"]:
+        print(f"{key}: {100 * summary[key][0]:.2f}% +- {100 * summary[key][1]:.2f}%")
+    print("Place accuracy (most frequent wrong place):")
+    for p, place_name in enumerate(summary["places"]):
+        if place_name not in summary["place_accuracy"]:
+            continue
+        errors = summary["confusion"][p].copy()
+        errors[p] = 0
+        wrong_place = summary["places"][int(np.argmax(errors))] if errors.any() else "-"
+        print(f"{place_name}: {100 * summary['place_accuracy'][place_name]:.2f}% ({wrong_place})")
+
 def main():
     """
     Main function to run the benchmarking tool for RSSI-based localization.
-    This function prompts the user to choose between using real or mockup data, then runs the benchmark tests and plots the results.
+    This function prompts the user to choose between using real or mockup data, then runs the benchmark tests in
+    parallel and prints and plots the results.
     """
     connection = {
         "url": TTN_URL,
@@ -171,47 +390,60 @@ def main():
             "Authorization": "Bearer " + ttn_apikey
         }
     }
-    json_data = []
     print("Benchmark tool")
     print("Type 'R' to use real data")
     print("Type 'M' to use mockup data (for testing)")
     command = input("Command: ").strip().lower()
+    # The data is converted to columnar once here, every run slices the places of it without copying the messages
     if command == 'r':
-        json_data = ttn_data.fetch_data(connection["url"], connection["headers"])
+        parsed_data = message_store.get_columnar_data(connection)
     elif command == 'm':
-        json_data = True
+        parsed_data = ttn_data.to_columnar(parsed_data_stored)
     else:
         print("Unknown command. Exit.")
         return
+    available_gateways = ["rak7248-grc-pm65","main-gtw-grc","itaca-upv-022"]
+    fingerprint_map = fingerprint.load_fingerprint(fingerprint.MAP_FILE_PATH, available_gateways)
     time_map = time_mapping.time_map()
-    if json_data:
-        parsed_data = []
-        if command == 'r':
-            parsed_data = ttn_data.parse_json_data(json_data)
-        elif command == 'm':
-            parsed_data = parsed_data_stored
+    if len(parsed_data["received_at"]):
+        seed = input("Seed (empty for random): ").strip()
+        seed = int(seed) if seed else None
         # Get the best RSS_NULL value
+        print("Fine RSS_NULL search (0.1 dB)? (Y/N)")
+        command = input("Command: ").strip().lower()
+        refine_step = 0.1 if command == 'y' else None
         print("Running best RSS_NULL test...")
-        rss_null_sum = 0
-        rss_null_count = 0
-        for _ in range(30):
-            benckmark_tests = generate_benchmark_tests(parsed_data, time_map, 5)
-            rss_null_result = get_best_rss_null(0, -400, -1, copy.deepcopy(benckmark_tests), copy.deepcopy(rss_map), RSS_NULL)
-            rss_null_sum += rss_null_result[0]
-            rss_null_count += 1
-        print("Best RSS_NULL:",rss_null_sum/rss_null_count)
+        seed, rss_null_results = run_parallel_benchmark("rss_null", parsed_data, time_map, available_gateways, seed=seed, refine_step=refine_step)
+        print("Seed:", seed)
+        rss_null, rss_null_ci = _mean_ci([rss_null_result[0] for rss_null_result in rss_null_results])
+        print(f"Best RSS_NULL: {rss_null} +- {rss_null_ci:.2f}")
         
         # Run benchmark using the default RSS_NULL value
         print("Running benchmark...")
-        print("This test does not use the calculated RSS_NULL. Using:", RSS_NULL)
-        benchmark_results = []
-        for _ in range(30):
-            benckmark_tests = generate_benchmark_tests(parsed_data, time_map, 5)
-            benchmark_result = run_benchmark(copy.deepcopy(benckmark_tests), copy.deepcopy(rss_map), RSS_NULL)
-            benchmark_results.append(benchmark_result)
+        print("This test does not use the calculated RSS_NULL. Using:", fingerprint_map["rss_null"])
+        seed, benchmark_results = run_parallel_benchmark("accuracy", parsed_data, time_map, available_gateways, seed=seed)
+        print_benchmark_summary(summarize_benchmark(benchmark_results, fingerprint_map["places"]))
         plot_benchmark_accuracy(benchmark_results)
+
+        # Compare the accuracy and the cost of every classifier on the same tests
+        print("Running classifiers comparison...")
+        seed, classifiers_results = run_parallel_benchmark("classifiers", parsed_data, time_map, available_gateways, seed=seed)
+        for name in classifiers_results[0]:
+            runs = [run[name] for run in classifiers_results]
+            keys = ["accuracy", "zone_accuracy", "floor_accuracy", "top_k_accuracy", "confidence", "position_error", "ms_per_test"]
+            results = {key: _mean_ci([run[key] for run in runs]) for key in keys}
+            print(f"{name}: " + ", ".join(f"{key} {value:.3f} +- {ci:.3f}" for key, (value, ci) in results.items()))
+
+        # Accuracy lost by pruning the places of the unlikely floors and zones
+        print("Running hierarchical search comparison...")
+        seed, hierarchical_results = run_parallel_benchmark("hierarchical", parsed_data, time_map, available_gateways, seed=seed)
+        for name in hierarchical_results[0]:
+            runs = [run[name] for run in hierarchical_results]
+            keys = ["accuracy", "zone_accuracy", "floor_accuracy", "ms_per_test"] + (["agreement", "scored_places"] if name != "exhaustive" else [])
+            results = {key: _mean_ci([run[key] for run in runs]) for key in keys}
+            print(f"{name}: " + ", ".join(f"{key} {value:.3f} +- {ci:.3f}" for key, (value, ci) in results.items()))
     else:
         print("No data available")
         
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,797 @@
+from collections import OrderedDict
+import numpy as np
+import threading
+import json
+import time
+import os
+
+# EU868 channels 0-7 plus the 868.8 MHz channel (8), see ttn_data.get_channel
+CHANNEL_QTY = 9
+# Channels filled with RSS_NULL for the gateways missing in a place
+MAP_CHANNEL_QTY = 8
+# Maximum number of float elements handled per scoring chunk
+SCORE_CHUNK_SIZE = 1 << 22
+# RSSI variance (dB^2) used by the Gaussian classifier where the map has none, and minimum variance allowed
+DEFAULT_RSS_VARIANCE = 16.0
+MIN_RSS_VARIANCE = 1.0
+# Number of nearest places weighted by the k-NN classifier, and minimum spread (m^2) of their positions
+KNN_NEIGHBOURS = 3
+KNN_MIN_SPREAD = 1.0
+EARTH_RADIUS = 6371000
+# Classification cache: maximum entries, seconds an entry stays valid and RSSI quantization step (dB) of the keys
+CLASSIFICATION_CACHE_SIZE = 4096
+CLASSIFICATION_CACHE_TTL = 300
+OBSERVATION_QUANTUM = 1.0
+# Place name prefixes identifying the floor and the zone (e.g. place "1b3" is in zone "1b" of floor "1")
+FLOOR_PREFIX = 1
+ZONE_PREFIX = 2
+# Candidate floors and zones kept at each level of the hierarchical search
+HIERARCHY_FLOOR_BEAM = 2
+HIERARCHY_ZONE_BEAM = 3
+MAP_FILE_PATH = os.path.join("maps", "disca_map.fpm")
+# Map published by the online map builder (see online_map.py), hot-reloaded by the localization tools
+PUBLISHED_MAP_PATH = os.path.join("maps", "online_map.fpm")
+MAP_FILE_MAGIC = b"TTNFPMAP"
+MAP_FILE_FORMAT = 2
+# Alignment of the arrays inside the map file
+MAP_FILE_ALIGNMENT = 64
+
+def build_fingerprint(rss_map, RSS_NULL, available_gateways, version=0, rss_var=None):
+    """
+    Compile an RSS map into a dense fingerprint tensor.
+    Inputs:
+    - rss_map: Dictionary containing RSS values for each category and gateway.
+    - RSS_NULL: Default RSS value for missing data.
+    - available_gateways: List of gateways available for the classification.
+    - version: Version of the map, used to detect updated maps.
+    - rss_var: Optional dictionary with the RSS variance for each category and gateway.
+    Outputs:
+    - Returns a dictionary with the place and gateway axes, the values tensor (places x gateways x channels, RSS_NULL
+      where the value is RSS_NULL or missing), the validity mask and the variance tensor (NaN where unknown, None
+      without rss_var). The arrays are read-only and the rss_map is not modified.
+    """
+    places = list(rss_map.keys())
+    gateways = list(available_gateways)
+    for place in places:
+        for gateway in rss_map[place].keys():
+            if gateway not in gateways:
+                gateways.append(gateway)
+    gateway_index = {gateway: g for g, gateway in enumerate(gateways)}
+    values = np.full((len(places), len(gateways), CHANNEL_QTY), float(RSS_NULL))
+    mask = np.zeros((len(places), len(gateways), CHANNEL_QTY), dtype=bool)
+    variance = np.full((len(places), len(gateways), CHANNEL_QTY), np.nan) if rss_var is not None else None
+    for p, place in enumerate(places):
+        for gateway, ch_rssi in rss_map[place].items():
+            g = gateway_index[gateway]
+            for ch, rssi in ch_rssi.items():
+                if ch is None or not 0 <= ch < CHANNEL_QTY:
+                    continue
+                values[p, g, ch] = rssi
+                mask[p, g, ch] = True
+                if rss_var and ch in rss_var.get(place, {}).get(gateway, {}):
+                    variance[p, g, ch] = rss_var[place][gateway][ch]
+        # Gateways missing in this place count as RSS_NULL (the missing values are already RSS_NULL)
+        for gateway in available_gateways:
+            if gateway not in rss_map[place]:
+                mask[p, gateway_index[gateway], :MAP_CHANNEL_QTY] = True
+    return _freeze_fingerprint({
+        "places": places,
+        "gateways": gateways,
+        "gateway_index": gateway_index,
+        "available_gateways": list(available_gateways),
+        "rss_null": RSS_NULL,
+        "version": version,
+        "values": values,
+        "mask": mask,
+        "variance": variance
+    })
+
+def _freeze_fingerprint(fingerprint):
+    """
+    Make every array of a fingerprint read-only.
+    """
+    for key in ["values", "mask", "variance"]:
+        if fingerprint[key] is not None:
+            fingerprint[key].flags.writeable = False
+    return fingerprint
+
+def _map_values(fingerprint, RSS_NULL):
+    """
+    Get the fingerprint values as a (places x gateways*channels) view, only copied when scored with another RSS_NULL.
+    """
+    values = fingerprint["values"].reshape(len(fingerprint["values"]), -1)
+    if RSS_NULL == fingerprint["rss_null"]:
+        return values
+    return np.where(values == fingerprint["rss_null"], RSS_NULL, values)
+
+def _pack_into(fingerprint, new_data, tx_channels_used, values, mask):
+    """
+    Write an observation dictionary into preallocated values and mask arrays (gateways x channels).
+    """
+    gateway_index = fingerprint["gateway_index"]
+    for gateway, ch_rssi in new_data.items():
+        if gateway not in gateway_index:
+            continue
+        for ch, rssi in ch_rssi.items():
+            if ch is None or not 0 <= ch < CHANNEL_QTY:
+                continue
+            values[gateway_index[gateway], ch] = rssi
+            mask[gateway_index[gateway], ch] = True
+    # Missing gateways get RSS_NULL on the channels of the first received gateway
+    if new_data:
+        existing_channels = [ch for ch in next(iter(new_data.values())).keys() if ch is not None and 0 <= ch < CHANNEL_QTY]
+        for gateway in fingerprint["available_gateways"]:
+            if gateway not in new_data:
+                values[gateway_index[gateway], existing_channels] = np.nan
+                mask[gateway_index[gateway], existing_channels] = True
+    # Previously used TX channels not received get RSS_NULL
+    for ch in range(MAP_CHANNEL_QTY):
+        if (tx_channels_used >> ch) & 1:
+            for gateway in fingerprint["available_gateways"]:
+                g = gateway_index[gateway]
+                if not mask[g, ch]:
+                    values[g, ch] = np.nan
+                    mask[g, ch] = True
+
+def pack_observation(fingerprint, new_data, tx_channels_used):
+    """
+    Pack an observation dictionary into arrays aligned with the fingerprint axes.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint.
+    - new_data: Dictionary of new RSS data (gateway -> channel -> RSSI) to be classified.
+    - tx_channels_used: Bitmask indicating which transmission channels are been used.
+    Outputs:
+    - Returns the values (gateways x channels, NaN where RSS_NULL is assumed) and the validity mask.
+    """
+    shape = (len(fingerprint["gateways"]), CHANNEL_QTY)
+    values = np.zeros(shape)
+    mask = np.zeros(shape, dtype=bool)
+    _pack_into(fingerprint, new_data, tx_channels_used, values, mask)
+    return values, mask
+
+def pack_observations(fingerprint, observations, tx_channels_used):
+    """
+    Pack a list of observation dictionaries into batch arrays aligned with the fingerprint axes.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint.
+    - observations: List of observation dictionaries (gateway -> channel -> RSSI).
+    - tx_channels_used: Bitmask shared by all the observations, or a list with one bitmask per observation.
+    Outputs:
+    - Returns the values (N x gateways x channels, NaN where RSS_NULL is assumed) and the validity mask.
+    """
+    if isinstance(tx_channels_used, int):
+        tx_channels_used = [tx_channels_used] * len(observations)
+    shape = (len(observations), len(fingerprint["gateways"]), CHANNEL_QTY)
+    values = np.zeros(shape)
+    mask = np.zeros(shape, dtype=bool)
+    for i, new_data in enumerate(observations):
+        _pack_into(fingerprint, new_data, tx_channels_used[i], values[i], mask[i])
+    return values, mask
+
+def score_observations(fingerprint, obs_values, obs_mask, RSS_NULL=None, places=None):
+    """
+    Compute the summed squared error of one or many observations against every place.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint.
+    - obs_values: Observation values (gateways x channels) or a batch of them (N x gateways x channels).
+    - obs_mask: Validity mask with the same shape as obs_values.
+    - RSS_NULL: Value used for the RSS_NULL positions, defaults to the fingerprint one.
+    - places: Optional array with the indices of the places scored, all of them by default.
+    Outputs:
+    - Returns the error scores (places) for a single observation or (N x places) for a batch.
+    """
+    if RSS_NULL is None:
+        RSS_NULL = fingerprint["rss_null"]
+    single = obs_values.ndim == 2
+    if single:
+        obs_values = obs_values[np.newaxis]
+        obs_mask = obs_mask[np.newaxis]
+    map_values = _map_values(fingerprint, RSS_NULL)
+    map_mask = fingerprint["mask"].reshape(len(map_values), -1)
+    if places is not None:
+        map_values = map_values[places]
+        map_mask = map_mask[places]
+    place_qty = len(map_values)
+    obs_values = np.where(np.isnan(obs_values), RSS_NULL, obs_values).reshape(len(obs_values), -1)
+    obs_mask = obs_mask.reshape(len(obs_mask), -1)
+    scores = np.empty((len(obs_values), place_qty))
+    chunk = max(1, SCORE_CHUNK_SIZE // max(1, map_values.size))
+    for begin in range(0, len(obs_values), chunk):
+        end = begin + chunk
+        squared_errors = (obs_values[begin:end, np.newaxis, :] - map_values[np.newaxis]) ** 2
+        valid = obs_mask[begin:end, np.newaxis, :] & map_mask[np.newaxis]
+        scores[begin:end] = np.where(valid, squared_errors, 0).sum(axis=2)
+    return scores[0] if single else scores
+
+def classify_observation(fingerprint, new_data, tx_channels_used):
+    """
+    Classify an observation into the best matching place of a fingerprint.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint.
+    - new_data: Dictionary of new RSS data to be classified.
+    - tx_channels_used: Bitmask indicating which transmission channels are been used.
+    Outputs:
+    - Returns the best matching place and a dictionary with the error score of every place.
+    """
+    obs_values, obs_mask = pack_observation(fingerprint, new_data, tx_channels_used)
+    scores = score_observations(fingerprint, obs_values, obs_mask)
+    best_category = fingerprint["places"][int(np.argmin(scores))]
+    return best_category, dict(zip(fingerprint["places"], scores.tolist()))
+
+def new_classification_cache(max_size=CLASSIFICATION_CACHE_SIZE, ttl=CLASSIFICATION_CACHE_TTL, quantum=OBSERVATION_QUANTUM):
+    """
+    Create an LRU cache of classifications, for devices reporting nearly the same observation cycle after cycle.
+    Inputs:
+    - max_size: Maximum number of cached classifications, the least recently used one is evicted first.
+    - ttl: Seconds a cached classification stays valid (None to keep it until evicted).
+    - quantum: RSSI step (dB) of the observation keys, observations equal after rounding share their classification.
+    Outputs:
+    - Returns a dictionary with the cache state and its hit and miss counters.
+    """
+    return {
+        "max_size": max_size,
+        "ttl": ttl,
+        "quantum": quantum,
+        "entries": OrderedDict(),
+        # The cache is cleared when used with another fingerprint
+        "fingerprint": None,
+        "hits": 0,
+        "misses": 0,
+        "lock": threading.Lock()
+    }
+
+def classify_observation_cached(cache, fingerprint, new_data, tx_channels_used):
+    """
+    Classify an observation (see classify_observation), reusing the cached classification of an equal quantized
+    observation with the same map version and TX channels.
+    Inputs:
+    - cache: Classification cache (see new_classification_cache).
+    - fingerprint: Fingerprint returned by build_fingerprint or load_fingerprint.
+    - new_data: Dictionary of new RSS data to be classified.
+    - tx_channels_used: Bitmask indicating which transmission channels are been used.
+    Outputs:
+    - Returns the best matching place and a dictionary with the error score of every place (shared with the cache,
+      not to be modified).
+    """
+    obs_values, obs_mask = pack_observation(fingerprint, new_data, tx_channels_used)
+    # RSS_NULL positions (NaN) are told apart from the measured values by the mask and the NaN flags
+    quantized = np.where(np.isnan(obs_values), 0, np.round(np.nan_to_num(obs_values) / cache["quantum"])).astype(np.int32)
+    key = (fingerprint["version"], tx_channels_used, quantized.tobytes(), obs_mask.tobytes(), np.isnan(obs_values).tobytes())
+    now = time.monotonic()
+    with cache["lock"]:
+        if cache["fingerprint"] is not fingerprint:
+            cache["entries"].clear()
+            cache["fingerprint"] = fingerprint
+        entry = cache["entries"].get(key)
+        if entry is not None and (cache["ttl"] is None or now - entry[0] < cache["ttl"]):
+            cache["entries"].move_to_end(key)
+            cache["hits"] += 1
+            return entry[1]
+        cache["misses"] += 1
+    scores = score_observations(fingerprint, obs_values, obs_mask)
+    result = (fingerprint["places"][int(np.argmin(scores))], dict(zip(fingerprint["places"], scores.tolist())))
+    with cache["lock"]:
+        if cache["fingerprint"] is fingerprint:
+            cache["entries"][key] = (now, result)
+            cache["entries"].move_to_end(key)
+            while len(cache["entries"]) > cache["max_size"]:
+                cache["entries"].popitem(last=False)
+    return result
+
+def classify_observations(fingerprint, obs_values, obs_mask, RSS_NULL=None):
+    """
+    Classify a batch of packed observations in a single scoring pass.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint.
+    - obs_values: Observation values (N x gateways x channels), see pack_observations.
+    - obs_mask: Validity mask with the same shape as obs_values.
+    - RSS_NULL: Value used for the RSS_NULL positions, defaults to the fingerprint one.
+    Outputs:
+    - Returns the list of N best matching places and the error score matrix (N x places).
+    """
+    scores = score_observations(fingerprint, obs_values, obs_mask, RSS_NULL)
+    best_places = [fingerprint["places"][p] for p in np.argmin(scores, axis=1)]
+    return best_places, scores
+
+def place_positions(places, coordinates):
+    """
+    Project the coordinates of the places onto a local plane, for the classifiers and filters working with positions.
+    Inputs:
+    - places: List of place names (e.g. the places of a fingerprint).
+    - coordinates: Dictionary with the 'latitude' and 'longitude' of the places (e.g. disca_coord).
+    Outputs:
+    - Returns the (places x 2) array of positions in meters, NaN for the places without coordinates.
+    """
+    positions = np.full((len(places), 2), np.nan)
+    located = [p for p, place in enumerate(places) if place in coordinates]
+    if located:
+        latitudes = np.radians([coordinates[places[p]]["latitude"] for p in located])
+        longitudes = np.radians([coordinates[places[p]]["longitude"] for p in located])
+        # Equirectangular projection, accurate enough at building scale
+        positions[located, 0] = EARTH_RADIUS * np.cos(latitudes.mean()) * longitudes
+        positions[located, 1] = EARTH_RADIUS * latitudes
+    return positions
+
+def score_classifiers(fingerprint, obs_values, obs_mask, RSS_NULL=None, positions=None):
+    """
+    Compute in a single pass the scores used by all the classifiers: the summed squared error and the Gaussian
+    negative log-likelihood of every observation in every place.
+    The Gaussian likelihood uses the per (place, gateway, channel) variance of the fingerprint, DEFAULT_RSS_VARIANCE
+    where it is unknown (or RSS_NULL), and at least MIN_RSS_VARIANCE.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint or load_fingerprint.
+    - obs_values: Observation values (N x gateways x channels), see pack_observations.
+    - obs_mask: Validity mask with the same shape as obs_values.
+    - RSS_NULL: Value used for the RSS_NULL positions, defaults to the fingerprint one.
+    - positions: Optional positions of the places (see place_positions), required by the k-NN classifier.
+    Outputs:
+    - Returns a dictionary with the "squared_error" and "gaussian" score matrices (N x places) and the "positions".
+    """
+    if RSS_NULL is None:
+        RSS_NULL = fingerprint["rss_null"]
+    place_qty = len(fingerprint["places"])
+    map_values = _map_values(fingerprint, RSS_NULL)
+    map_mask = fingerprint["mask"].reshape(place_qty, -1)
+    variance = fingerprint.get("variance")
+    if variance is None:
+        # Same variance everywhere, no tensor needed
+        variance = np.float64(DEFAULT_RSS_VARIANCE)
+    else:
+        variance = np.where((fingerprint["values"] == fingerprint["rss_null"]) | np.isnan(variance), DEFAULT_RSS_VARIANCE, variance).reshape(place_qty, -1)
+        variance = np.maximum(variance, MIN_RSS_VARIANCE)
+    inverse_variance = 1 / variance
+    log_variance = np.log(2 * np.pi * variance)
+    obs_values = np.where(np.isnan(obs_values), RSS_NULL, obs_values).reshape(len(obs_values), -1)
+    obs_mask = obs_mask.reshape(len(obs_mask), -1)
+    squared_error = np.empty((len(obs_values), place_qty))
+    gaussian = np.empty((len(obs_values), place_qty))
+    chunk = max(1, SCORE_CHUNK_SIZE // max(1, map_values.size))
+    for begin in range(0, len(obs_values), chunk):
+        end = begin + chunk
+        squared_errors = (obs_values[begin:end, np.newaxis, :] - map_values[np.newaxis]) ** 2
+        valid = obs_mask[begin:end, np.newaxis, :] & map_mask[np.newaxis]
+        squared_error[begin:end] = np.where(valid, squared_errors, 0).sum(axis=2)
+        gaussian[begin:end] = 0.5 * np.where(valid, squared_errors * inverse_variance + log_variance, 0).sum(axis=2)
+    return {"squared_error": squared_error, "gaussian": gaussian, "positions": positions}
+
+def _softmax_probabilities(negative_log_scores):
+    """
+    Normalize scores given as negative log-likelihoods (N x places) into probabilities.
+    """
+    exponents = -(negative_log_scores - negative_log_scores.min(axis=1, keepdims=True))
+    probabilities = np.exp(exponents)
+    return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+def least_squares_probabilities(scores):
+    """
+    Least squares classifier: the squared error as a Gaussian likelihood with the same DEFAULT_RSS_VARIANCE everywhere.
+    Inputs:
+    - scores: Dictionary returned by score_classifiers.
+    Outputs:
+    - Returns the probability of every place (N x places).
+    """
+    return _softmax_probabilities(0.5 * scores["squared_error"] / DEFAULT_RSS_VARIANCE)
+
+def knn_probabilities(scores, k=KNN_NEIGHBOURS):
+    """
+    Weighted k-nearest-neighbours (WKNN) classifier: the device position is the mean position of the k places with the
+    shortest RSS distance, weighted by inverse distance, and the places are ranked by their distance to that position
+    (Gaussian kernel as wide as the spread of the k neighbours). Observations between several similar fingerprints are
+    classified to the place between them, not always to the least squares one.
+    Inputs:
+    - scores: Dictionary returned by score_classifiers, with the positions of the places.
+    - k: Number of nearest places.
+    Outputs:
+    - Returns the probability of every place (N x places), zero for the places without position.
+    """
+    if scores["positions"] is None:
+        raise ValueError("The k-NN classifier needs the positions of the places")
+    located = np.flatnonzero(~np.isnan(scores["positions"][:, 0]))
+    positions = scores["positions"][located]
+    distances = np.sqrt(scores["squared_error"][:, located])
+    k = min(k, len(located))
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    weights = 1 / (np.take_along_axis(distances, nearest, axis=1) + 1e-9)
+    weights /= weights.sum(axis=1, keepdims=True)
+    estimates = np.einsum("nk,nkd->nd", weights, positions[nearest])
+    spread = np.einsum("nk,nk->n", weights, ((positions[nearest] - estimates[:, np.newaxis]) ** 2).sum(axis=2))
+    squared_distances = ((positions[np.newaxis] - estimates[:, np.newaxis]) ** 2).sum(axis=2)
+    probabilities = np.zeros(scores["squared_error"].shape)
+    probabilities[:, located] = _softmax_probabilities(0.5 * squared_distances / np.maximum(spread, KNN_MIN_SPREAD)[:, np.newaxis])
+    return probabilities
+
+def gaussian_probabilities(scores):
+    """
+    Gaussian likelihood classifier using the RSS variance of every (place, gateway, channel).
+    Inputs:
+    - scores: Dictionary returned by score_classifiers.
+    Outputs:
+    - Returns the probability of every place (N x places).
+    """
+    return _softmax_probabilities(scores["gaussian"])
+
+# Classifiers available over the shared scores (name -> function returning the place probabilities)
+CLASSIFIERS = {
+    "least_squares": least_squares_probabilities,
+    "knn": knn_probabilities,
+    "gaussian": gaussian_probabilities
+}
+
+def default_classifiers(positions=None):
+    """
+    Get the names of the classifiers that can run with or without the positions of the places.
+    """
+    return [name for name in CLASSIFIERS if positions is not None or name != "knn"]
+
+def classify_top_k(fingerprint, obs_values, obs_mask, classifiers=None, k=3, RSS_NULL=None, positions=None):
+    """
+    Classify a batch of packed observations with several classifiers from a single scoring pass.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint or load_fingerprint.
+    - obs_values: Observation values (N x gateways x channels), see pack_observations.
+    - obs_mask: Validity mask with the same shape as obs_values.
+    - classifiers: List of classifier names (see CLASSIFIERS), all the ones that can run by default (see default_classifiers).
+    - k: Number of most probable places returned.
+    - RSS_NULL: Value used for the RSS_NULL positions, defaults to the fingerprint one.
+    - positions: Optional positions of the places (see place_positions), required by the k-NN classifier.
+    Outputs:
+    - Returns a dictionary with, for every classifier, the k most probable places of every observation (N x k names,
+      most probable first) and their normalized probabilities (N x k).
+    """
+    scores = score_classifiers(fingerprint, obs_values, obs_mask, RSS_NULL, positions)
+    k = min(k, len(fingerprint["places"]))
+    results = {}
+    for name in classifiers or default_classifiers(positions):
+        probabilities = CLASSIFIERS[name](scores)
+        # Stable sort so ties keep the map order, like the argmin of the least squares classification
+        top = np.argsort(-probabilities, axis=1, kind="stable")[:, :k]
+        results[name] = ([[fingerprint["places"][p] for p in row] for row in top], np.take_along_axis(probabilities, top, axis=1))
+    return results
+
+def _envelopes(map_values, map_mask, groups, group_qty):
+    """
+    Get the per entry range (lowest and highest value) of the places of every group and the entries all of them have.
+    """
+    low = np.full((group_qty, map_values.shape[1]), np.inf)
+    high = np.full((group_qty, map_values.shape[1]), -np.inf)
+    common = np.ones((group_qty, map_values.shape[1]), dtype=bool)
+    np.minimum.at(low, groups, map_values)
+    np.maximum.at(high, groups, map_values)
+    np.logical_and.at(common, groups, map_mask)
+    return {"low": low, "high": high, "mask": common}
+
+def _score_envelopes(envelopes, obs_values, obs_mask, RSS_NULL):
+    """
+    Get a lower bound of the error score (see score_observations) of every observation against every place of every
+    group: the squared distance to the value range of the group, over the entries all its places have.
+    """
+    obs_values = np.where(np.isnan(obs_values), RSS_NULL, obs_values).reshape(len(obs_values), -1)
+    obs_mask = obs_mask.reshape(len(obs_mask), -1)
+    low, high = envelopes["low"][np.newaxis], envelopes["high"][np.newaxis]
+    scores = np.empty((len(obs_values), len(envelopes["low"])))
+    chunk = max(1, SCORE_CHUNK_SIZE // max(1, envelopes["low"].size))
+    for begin in range(0, len(obs_values), chunk):
+        end = begin + chunk
+        values = obs_values[begin:end, np.newaxis, :]
+        distances = np.maximum(np.maximum(low - values, values - high), 0)
+        valid = obs_mask[begin:end, np.newaxis, :] & envelopes["mask"][np.newaxis]
+        scores[begin:end] = np.where(valid, distances ** 2, 0).sum(axis=2)
+    return scores
+
+def build_hierarchy(fingerprint, RSS_NULL=None):
+    """
+    Group the places of a fingerprint by floor and zone, using the place name prefixes (see FLOOR_PREFIX and ZONE_PREFIX).
+    Every group keeps the range of the values of its places, so the distance of an observation to the range is a lower
+    bound of its error score in any place of the group: unlike an average of the places, it is not pulled towards
+    RSS_NULL by the places that do not hear a gateway, nor away from the places that do.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint or load_fingerprint.
+    - RSS_NULL: Value used for the RSS_NULL positions, defaults to the fingerprint one.
+    Outputs:
+    - Returns a dictionary with the value ranges of the floors and zones, the floor of every zone and the place indices
+      of every zone.
+    """
+    if RSS_NULL is None:
+        RSS_NULL = fingerprint["rss_null"]
+    place_zones = [place[:ZONE_PREFIX] for place in fingerprint["places"]]
+    zones = list(dict.fromkeys(place_zones))
+    zone_index = {zone: z for z, zone in enumerate(zones)}
+    floors = list(dict.fromkeys(zone[:FLOOR_PREFIX] for zone in zones))
+    floor_index = {floor: f for f, floor in enumerate(floors)}
+    zone_of_place = np.array([zone_index[zone] for zone in place_zones], dtype=np.intp)
+    floor_of_zone = np.array([floor_index[zone[:FLOOR_PREFIX]] for zone in zones], dtype=np.intp)
+    map_values = _map_values(fingerprint, RSS_NULL)
+    map_mask = fingerprint["mask"].reshape(len(map_values), -1)
+    return {
+        "rss_null": RSS_NULL,
+        "floors": dict(_envelopes(map_values, map_mask, floor_of_zone[zone_of_place], len(floors)), places=floors),
+        "zones": dict(_envelopes(map_values, map_mask, zone_of_place, len(zones)), places=zones),
+        "floor_of_zone": floor_of_zone,
+        "zone_places": [np.flatnonzero(zone_of_place == z) for z in range(len(zones))]
+    }
+
+def _score_zones(fingerprint, hierarchy, obs_values, obs_mask, RSS_NULL, scores, zone_sets):
+    """
+    Score the places of the given zones of every observation into the score matrix, observations sharing the same
+    zones together.
+    """
+    groups = {}
+    for n, zones in enumerate(zone_sets):
+        if len(zones):
+            groups.setdefault(tuple(zones), []).append(n)
+    for zones, rows in groups.items():
+        places = np.concatenate([hierarchy["zone_places"][z] for z in zones])
+        scores[np.ix_(rows, places)] = score_observations(fingerprint, obs_values[rows], obs_mask[rows], RSS_NULL, places)
+
+def classify_hierarchical(fingerprint, obs_values, obs_mask, hierarchy=None, floor_beam=HIERARCHY_FLOOR_BEAM,
+                          zone_beam=HIERARCHY_ZONE_BEAM, RSS_NULL=None, exact=True):
+    """
+    Classify a batch of packed observations scoring only the places of the most likely zones.
+    The floors are ranked by the lower bound of the error score of their places, then the zones of the best
+    'floor_beam' floors, and the places of the best 'zone_beam' zones of those floors are scored. When exact, the
+    places of any other zone whose lower bound does not exceed the best score found are scored as well, so the result
+    is the exhaustive one and the beams only set how many zones are tried first.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint or load_fingerprint.
+    - obs_values: Observation values (N x gateways x channels), see pack_observations.
+    - obs_mask: Validity mask with the same shape as obs_values.
+    - hierarchy: Hierarchy of the fingerprint (see build_hierarchy), built on every call when None or built with
+      another RSS_NULL.
+    - floor_beam: Number of candidate floors kept.
+    - zone_beam: Number of candidate zones kept.
+    - RSS_NULL: Value used for the RSS_NULL positions, defaults to the fingerprint one.
+    - exact: Whether to check the zones outside the beams against the best score found.
+    Outputs:
+    - Returns the list of N best matching places and the (N x places) score matrix, infinite for the pruned places.
+    """
+    if RSS_NULL is None:
+        RSS_NULL = fingerprint["rss_null"]
+    if hierarchy is None or hierarchy["rss_null"] != RSS_NULL:
+        hierarchy = build_hierarchy(fingerprint, RSS_NULL)
+    floor_bounds = _score_envelopes(hierarchy["floors"], obs_values, obs_mask, RSS_NULL)
+    floor_candidates = np.argsort(floor_bounds, axis=1, kind="stable")[:, :floor_beam]
+    # Zones outside the candidate floors are pruned
+    zone_bounds = _score_envelopes(hierarchy["zones"], obs_values, obs_mask, RSS_NULL)
+    allowed = (hierarchy["floor_of_zone"][np.newaxis, np.newaxis, :] == floor_candidates[:, :, np.newaxis]).any(axis=1)
+    zone_scores = np.where(allowed, zone_bounds, np.inf)
+    zone_candidates = np.sort(np.argsort(zone_scores, axis=1, kind="stable")[:, :zone_beam], axis=1)
+    scores = np.full((len(obs_values), len(fingerprint["places"])), np.inf)
+    _score_zones(fingerprint, hierarchy, obs_values, obs_mask, RSS_NULL, scores,
+                 [zones[np.isfinite(zone_scores[n, zones])] for n, zones in enumerate(zone_candidates)])
+    if exact:
+        # No place of a zone can score below its lower bound, the other zones cannot hold a better place
+        scored = np.zeros(zone_bounds.shape, dtype=bool)
+        np.put_along_axis(scored, zone_candidates, np.take_along_axis(np.isfinite(zone_scores), zone_candidates, axis=1), axis=1)
+        remaining = ~scored & (zone_bounds <= scores.min(axis=1)[:, np.newaxis])
+        _score_zones(fingerprint, hierarchy, obs_values, obs_mask, RSS_NULL, scores, [np.flatnonzero(row) for row in remaining])
+    best_places = np.argmin(scores, axis=1)
+    return [fingerprint["places"][p] for p in best_places], scores
+
+def sweep_rss_null(fingerprint, obs_values, obs_mask, rss_null_values):
+    """
+    Classify a batch of packed observations for many RSS_NULL values without rescoring them.
+    The squared error of every (observation, place) pair is a quadratic in the RSS_NULL value,
+    so its coefficients are computed once and then evaluated for all the candidate values.
+    Inputs:
+    - fingerprint: Fingerprint returned by build_fingerprint.
+    - obs_values: Observation values (N x gateways x channels), see pack_observations.
+    - obs_mask: Validity mask with the same shape as obs_values.
+    - rss_null_values: List of RSS_NULL values to evaluate.
+    Outputs:
+    - Returns the index of the best matching place for every RSS_NULL value and observation (values x N).
+    """
+    place_qty = len(fingerprint["places"])
+    map_mask = fingerprint["mask"].reshape(place_qty, -1)
+    map_null = (fingerprint["values"] == fingerprint["rss_null"]).reshape(place_qty, -1) & map_mask
+    map_real = map_mask & ~map_null
+    map_values = np.where(map_real, fingerprint["values"].reshape(place_qty, -1), 0)
+    obs_null = np.isnan(obs_values).reshape(len(obs_values), -1)
+    obs_mask = obs_mask.reshape(len(obs_mask), -1)
+    obs_real = obs_mask & ~obs_null
+    obs_null = obs_null & obs_mask
+    obs_values = np.where(obs_real, obs_values.reshape(len(obs_values), -1), 0)
+    map_null = map_null.astype(float)
+    map_real = map_real.astype(float)
+    obs_null = obs_null.astype(float)
+    # Constant term: real vs real errors plus the squares of the values compared against RSS_NULL
+    constant = np.empty((len(obs_values), place_qty))
+    chunk = max(1, SCORE_CHUNK_SIZE // max(1, map_values.size))
+    for begin in range(0, len(obs_values), chunk):
+        end = begin + chunk
+        squared_errors = (obs_values[begin:end, np.newaxis, :] - map_values[np.newaxis]) ** 2
+        valid = obs_real[begin:end, np.newaxis, :] & (map_real[np.newaxis] > 0)
+        constant[begin:end] = np.where(valid, squared_errors, 0).sum(axis=2)
+    constant += (obs_values ** 2) @ map_null.T + obs_null @ (map_values ** 2).T
+    # Linear and quadratic terms of the RSS_NULL value
+    linear = -2 * (obs_values @ map_null.T + obs_null @ map_values.T)
+    quadratic = obs_real.astype(float) @ map_null.T + obs_null @ map_real.T
+    rss_null_values = np.asarray(rss_null_values, dtype=float)
+    best_places = np.empty((len(rss_null_values), len(obs_values)), dtype=int)
+    chunk = max(1, SCORE_CHUNK_SIZE // max(1, constant.size))
+    for begin in range(0, len(rss_null_values), chunk):
+        x = rss_null_values[begin:begin + chunk, np.newaxis, np.newaxis]
+        scores = constant + x * linear + x * x * quadratic
+        best_places[begin:begin + chunk] = np.argmin(scores, axis=2)
+    return best_places
+
+def save_map_file(path, rss_map, RSS_NULL, rss_var=None, version=0):
+    """
+    Save an RSS map in the binary map file format, replacing the file atomically.
+    The file holds a JSON header (format, version, RSS_NULL, place names, gateway ids and channel count) followed by
+    aligned arrays: the float32 values tensor (places x gateways x channels, RSS_NULL where RSS_NULL or missing), the
+    presence mask (one byte per value, memory mapped as bool) and, optionally, the float32 variance tensor.
+    The values are stored ready to be scored, so the processes loading the file share them without any copy.
+    Inputs:
+    - path: Path of the map file.
+    - rss_map: Dictionary containing RSS values for each category and gateway.
+    - RSS_NULL: Default RSS value for missing data.
+    - rss_var: Optional dictionary with the RSS variance for each category and gateway.
+    - version: Version of the map.
+    """
+    places = list(rss_map.keys())
+    gateways = []
+    for place in places:
+        for gateway in rss_map[place].keys():
+            if gateway not in gateways:
+                gateways.append(gateway)
+    shape = (len(places), len(gateways), CHANNEL_QTY)
+    values = np.full(shape, RSS_NULL, dtype=np.float32)
+    present = np.zeros(shape, dtype=bool)
+    variance = np.full(shape, np.nan, dtype=np.float32)
+    for p, place in enumerate(places):
+        for gateway, ch_rssi in rss_map[place].items():
+            g = gateways.index(gateway)
+            for ch, rssi in ch_rssi.items():
+                if ch is None or not 0 <= ch < CHANNEL_QTY:
+                    continue
+                present[p, g, ch] = True
+                values[p, g, ch] = rssi
+                if rss_var and ch in rss_var.get(place, {}).get(gateway, {}):
+                    variance[p, g, ch] = rss_var[place][gateway][ch]
+    header = json.dumps({
+        "format": MAP_FILE_FORMAT,
+        "version": version,
+        "rss_null": RSS_NULL,
+        "places": places,
+        "gateways": gateways,
+        "channels": CHANNEL_QTY,
+        "variance": rss_var is not None
+    }).encode()
+    data_offset = -(-(len(MAP_FILE_MAGIC) + 4 + len(header)) // MAP_FILE_ALIGNMENT) * MAP_FILE_ALIGNMENT
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(MAP_FILE_MAGIC)
+        file.write(np.uint32(len(header)).tobytes())
+        file.write(header.ljust(data_offset - len(MAP_FILE_MAGIC) - 4, b" "))
+        for array in [values, present] + ([variance] if rss_var is not None else []):
+            file.write(array.tobytes())
+            file.write(b"\0" * (-file.tell() % MAP_FILE_ALIGNMENT))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+def load_map_file(path):
+    """
+    Load a binary map file, memory mapping its arrays so that processes loading the same file share one copy.
+    Inputs:
+    - path: Path of the map file.
+    Outputs:
+    - Returns a dictionary with the header fields and the read-only "values", "present" (bool) and "variance" (or None)
+      arrays. Files of the previous format (NaN where RSS_NULL) are converted in memory.
+    """
+    with open(path, "rb") as file:
+        if file.read(len(MAP_FILE_MAGIC)) != MAP_FILE_MAGIC:
+            raise ValueError("Not a map file: " + path)
+        header_length = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+        header = json.loads(file.read(header_length))
+    if header["format"] not in (1, MAP_FILE_FORMAT):
+        raise ValueError("Unsupported map file format: " + str(header["format"]))
+    shape = (len(header["places"]), len(header["gateways"]), header["channels"])
+    offset = -(-(len(MAP_FILE_MAGIC) + 4 + header_length) // MAP_FILE_ALIGNMENT) * MAP_FILE_ALIGNMENT
+    arrays = []
+    for dtype in [np.float32, np.bool_] + ([np.float32] if header["variance"] else []):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        arrays.append(np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape) if size else np.zeros(shape, dtype=dtype))
+        offset += -(-size // MAP_FILE_ALIGNMENT) * MAP_FILE_ALIGNMENT
+    # The first format stored NaN where RSS_NULL, regenerate the file to share the values again
+    header["values"] = arrays[0] if header["format"] == MAP_FILE_FORMAT else np.where(np.isnan(arrays[0]), np.float32(header["rss_null"]), arrays[0])
+    header["present"] = arrays[1]
+    header["variance"] = arrays[2] if header["variance"] else None
+    return header
+
+def load_fingerprint(path, available_gateways):
+    """
+    Load a binary map file as a fingerprint, sharing the memory mapped values tensor and mask.
+    They are only copied when some available gateways are missing in the map (new column) or in some places (mask padding).
+    Inputs:
+    - path: Path of the map file.
+    - available_gateways: List of gateways available for the classification.
+    Outputs:
+    - Returns a fingerprint equivalent to build_fingerprint over the same map (values stored as float32).
+    """
+    map_file = load_map_file(path)
+    values = map_file["values"]
+    present = map_file["present"]
+    variance = map_file["variance"]
+    gateways = list(map_file["gateways"])
+    # Available gateways never seen in the map need a new (copied) column
+    missing_gateways = [gateway for gateway in available_gateways if gateway not in gateways]
+    if missing_gateways:
+        extra_shape = (values.shape[0], len(missing_gateways), values.shape[2])
+        values = np.concatenate([values, np.full(extra_shape, map_file["rss_null"], dtype=values.dtype)], axis=1)
+        present = np.concatenate([present, np.zeros(extra_shape, dtype=bool)], axis=1)
+        if variance is not None:
+            variance = np.concatenate([variance, np.full(extra_shape, np.nan, dtype=variance.dtype)], axis=1)
+        gateways += missing_gateways
+    gateway_index = {gateway: g for g, gateway in enumerate(gateways)}
+    # Gateways missing in a place count as RSS_NULL (the missing values are already RSS_NULL)
+    mask = present
+    for gateway in available_gateways:
+        g = gateway_index[gateway]
+        missing_places = ~present[:, g, :].any(axis=1)
+        if missing_places.any():
+            if mask is present:
+                mask = np.array(present)
+            mask[missing_places, g, :MAP_CHANNEL_QTY] = True
+    return _freeze_fingerprint({
+        "places": list(map_file["places"]),
+        "gateways": gateways,
+        "gateway_index": gateway_index,
+        "available_gateways": list(available_gateways),
+        "rss_null": map_file["rss_null"],
+        "version": map_file["version"],
+        "values": values,
+        "mask": mask,
+        "variance": variance
+    })
+
+def reload_fingerprint_map(fingerprint_map, map_mtime, available_gateways, path=PUBLISHED_MAP_PATH):
+    """
+    Reload the fingerprint when a new map version has been published by the online map builder.
+    Inputs:
+    - fingerprint_map: Fingerprint currently in use.
+    - map_mtime: Modification time of the published map in use, None if it is not the published one.
+    - available_gateways: List of gateways available for the classification.
+    - path: Path of the published map.
+    Outputs:
+    - Returns the fingerprint of the latest published map and its modification time, or the current ones if nothing changed.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return fingerprint_map, map_mtime
+    if map_mtime == mtime:
+        return fingerprint_map, map_mtime
+    fingerprint_map = load_fingerprint(path, available_gateways)
+    print("Loaded map version", fingerprint_map["version"])
+    return fingerprint_map, mtime
+
+def load_localization_map(available_gateways, path=MAP_FILE_PATH, published_path=PUBLISHED_MAP_PATH):
+    """
+    Load the fingerprint used by the localization tools: the latest published map (see online_map.py) when there is
+    one, otherwise the binary map file, so either map is enough to start.
+    Inputs:
+    - available_gateways: List of gateways available for the classification.
+    - path: Path of the binary map file.
+    - published_path: Path of the published map.
+    Outputs:
+    - Returns the fingerprint and the modification time of the published map (None when the map file is used), to
+      keep hot-reloading it with reload_fingerprint_map. Raises FileNotFoundError when neither map exists.
+    """
+    fingerprint_map, map_mtime = reload_fingerprint_map(None, None, available_gateways, published_path)
+    if fingerprint_map is None:
+        fingerprint_map = load_fingerprint(path, available_gateways)
+    return fingerprint_map, map_mtime
+
+def main():
+    """
+    Main function to convert a map generated as a Python module (maps/disca_map.py) into the binary map file.
+    """
+    from maps.disca_map import rss_map, RSS_NULL
+    save_map_file(MAP_FILE_PATH, rss_map, RSS_NULL)
+    print("Map saved to", MAP_FILE_PATH)
+
+if __name__ == "__main__":
+    main()
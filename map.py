@@ -1,57 +1,99 @@
 from secrets_folder.secrets_file import ttn_apikey, TTN_URL
+import message_store
+import fingerprint
 import ttn_data
 import time_mapping
-from datetime import datetime, timezone
+import os
+
+RSS_NULL = -110
+RSS_MAP_STATISTICS = {
+    "a": ("mean", "average rss map"),
+    "g1": ("gauss_mad", "average gauss filtered (sigma MAD / 0.6745) rss map"),
+    "g2": ("gauss_std", "average gauss filtered (sigma std) rss map")
+}
+
+def print_rss_map(rss_maps, map_name):
+    """
+    Print an RSS map as a Python dictionary, filling the missing channels with RSS_NULL.
+    Inputs:
+    - rss_maps: Dictionary with the RSSI value per channel per gateway of every place.
+    - map_name: Name of the printed map variable.
+    """
+    print(f"{map_name} = {{")
+    for place_name, ch_rssi_gateways in rss_maps.items():
+        ch_rssi_gateways = dict(sorted(ch_rssi_gateways.items()))
+        for gateway_id, ch_rssi in ch_rssi_gateways.items():
+            # Fill channels using RSS_NULL
+            for ch in range(8):
+                if ch not in ch_rssi.keys():
+                    ch_rssi[ch] = 'RSS_NULL'
+            ch_rssi_gateways[gateway_id] = dict(sorted(ch_rssi.items()))     
+        print(f"'{place_name}':",str(ch_rssi_gateways).replace("'RSS_NULL'","RSS_NULL"))
+        print(",")
+    print("}")
+
+def save_rss_map(rss_maps, var_maps, RSS_NULL, path=fingerprint.MAP_FILE_PATH):
+    """
+    Save an RSS map in the binary map file format used by the localization tools, filling the missing channels 0-7 with RSS_NULL.
+    Inputs:
+    - rss_maps: Dictionary with the RSSI value per channel per gateway of every place.
+    - var_maps: Dictionary with the RSSI variance per channel per gateway of every place.
+    - RSS_NULL: Default RSS value for missing data.
+    - path: Path of the map file.
+    """
+    rss_map = {}
+    for place_name, ch_rssi_gateways in rss_maps.items():
+        rss_map[place_name] = {}
+        for gateway_id, ch_rssi in sorted(ch_rssi_gateways.items()):
+            # Channels 0-7 are filled with RSS_NULL, the extra channels (e.g. 868.8 MHz) are kept when measured
+            rss_map[place_name][gateway_id] = {ch: ch_rssi.get(ch, RSS_NULL) for ch in range(fingerprint.MAP_CHANNEL_QTY)}
+            rss_map[place_name][gateway_id].update({ch: rssi for ch, rssi in ch_rssi.items() if ch is not None and ch >= fingerprint.MAP_CHANNEL_QTY})
+    fingerprint.save_map_file(path, rss_map, RSS_NULL, var_maps)
+    print("Map saved to", path)
 
 def main():
     """
     Main function to fetch TTN data, process it, and print an RSS map based on user command.
     This function fetches data from the TTN URL, parses it, and then allows the user to choose between 
     calculating an average RSS map or a Gaussian-filtered RSS map using either the MAD or standard deviation.
+    All the statistics are computed in a single pass, so every map variant can be printed at once.
+    The selected map is also saved as a binary map file (see fingerprint.save_map_file).
     """ 
-    url = TTN_URL
-    headers = {
-        'Authorization': 'Bearer ' + ttn_apikey
+    connection = {
+        "url": TTN_URL,
+        "headers": {
+            "Authorization": "Bearer " + ttn_apikey
+        }
     }
     time_map = time_mapping.time_map()
-    json_data = ttn_data.fetch_data(url, headers)
-    if json_data:
-        parsed_data = ttn_data.parse_json_data(json_data)
-        print("Type 'A' to get average rss map")
-        print("Type 'G1' to get average gauss filtered (sigma MAD / 0.6745) rss map")
-        print("Type 'G2' to get average gauss filtered (sigma std) rss map")
+    columnar = message_store.get_columnar_data(connection)
+    if len(columnar["received_at"]):
+        for command, (statistic, description) in RSS_MAP_STATISTICS.items():
+            print(f"Type '{command.upper()}' to get {description}")
+        print("Type 'X' to get all the rss maps")
         while True: 
             command = input("Command: ").strip().lower()
-            if command in ['a','g1','g2']:
+            if command in ['a','g1','g2','x']:
                 break
             else:
                 print("Unknown command")
+        # Compute every statistic of every place in a single pass
+        stats = ttn_data.aggregate_rssi(columnar, time_map)
+        var_maps = ttn_data.rss_maps_from_stats(dict(stats, variance=stats["std"] ** 2), "variance")
         print("---------------------------")
-        print("RSS_NULL = -110")
-        print("rss_map = {")
-        # Iterate through all time tuples
-        for place in time_map:
-            (begin, end) = place["time_tuple"]
-            place_name = place["place_name"]
-            begin_end_messages = ttn_data.get_time_range_messages(parsed_data, begin, end)
-            ch_rssi_gateways = {}
-            if command == 'a':
-                ch_rssi_gateways = ttn_data.calculate_channels_avg_rssi(begin_end_messages)
-            elif command == 'g1':
-                ch_rssi_gateways = ttn_data.calculate_channels_gauss_rssi(begin_end_messages, 1)
-            elif command == 'g2':
-                ch_rssi_gateways = ttn_data.calculate_channels_gauss_rssi(begin_end_messages, 0)
-            ch_rssi_gateways = dict(sorted(ch_rssi_gateways.items()))
-            for gateway_id, ch_rssi in ch_rssi_gateways.items():
-                # Fill channels using RSS_NULL
-                for ch in range(8):
-                    if ch not in ch_rssi.keys():
-                        ch_rssi[ch] = 'RSS_NULL'
-                ch_rssi_gateways[gateway_id] = dict(sorted(ch_rssi.items()))     
-            print(f"'{place_name}':",str(ch_rssi_gateways).replace("'RSS_NULL'","RSS_NULL"))
-            print(",")
-        print("}")
+        print("RSS_NULL =", RSS_NULL)
+        if command == 'x':
+            for statistic, description in RSS_MAP_STATISTICS.values():
+                print("#", description)
+                print_rss_map(ttn_data.rss_maps_from_stats(stats, statistic), "rss_map_" + statistic)
+        else:
+            print_rss_map(ttn_data.rss_maps_from_stats(stats, RSS_MAP_STATISTICS[command][0]), "rss_map")
         print("---------------------------")
+        if command == 'x':
+            for statistic, description in RSS_MAP_STATISTICS.values():
+                save_rss_map(ttn_data.rss_maps_from_stats(stats, statistic), var_maps, RSS_NULL, os.path.join("maps", "disca_map_" + statistic + ".fpm"))
+        else:
+            save_rss_map(ttn_data.rss_maps_from_stats(stats, RSS_MAP_STATISTICS[command][0]), var_maps, RSS_NULL)
     else:
         print("No data available")
 
@@ -0,0 +1,180 @@
+from secrets_folder.secrets_file import ttn_apikey, TTN_URL
+import ttn_data
+import sqlite3
+import json
+import os
+
+DEFAULT_STORE_PATH = os.path.join("data", "ttn_messages.sqlite")
+# Number of messages inserted per database transaction while syncing
+SYNC_BATCH_SIZE = 1000
+
+def open_store(path=DEFAULT_STORE_PATH):
+    """
+    Open (and create if needed) the local message store.
+    Inputs:
+    - path: Path of the SQLite database file.
+    Outputs:
+    - Returns the SQLite connection to the store.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    store = sqlite3.connect(path)
+    store.execute("CREATE TABLE IF NOT EXISTS uplinks (url TEXT, received_at TEXT, message TEXT, PRIMARY KEY (url, received_at))")
+    store.execute("CREATE TABLE IF NOT EXISTS sync_state (url TEXT PRIMARY KEY, last_received_at TEXT)")
+    return store
+
+def received_at_key(received_at):
+    """
+    Get a sortable key for an RFC 3339 'received_at' timestamp with any number of fractional digits.
+    Inputs:
+    - received_at: Timestamp string in the format "YYYY-MM-DDTHH:MM:SS.fffffffffZ".
+    Outputs:
+    - Returns a tuple that sorts in chronological order.
+    """
+    seconds, _, fraction = received_at.rstrip("Z").partition(".")
+    return (seconds, fraction.ljust(9, "0"))
+
+def get_last_received_at(store, url):
+    """
+    Get the 'received_at' of the most recent message synced from a URL.
+    Inputs:
+    - store: Connection returned by open_store.
+    - url: The storage integration URL of the device.
+    Outputs:
+    - Returns the full precision timestamp string, or None if nothing was synced yet.
+    """
+    row = store.execute("SELECT last_received_at FROM sync_state WHERE url = ?", (url,)).fetchone()
+    return row[0] if row else None
+
+def sync_store(store, url, headers):
+    """
+    Fetch the messages newer than the last synced one and append them to the store.
+    The response is consumed as a stream and written in batches.
+    Inputs:
+    - store: Connection returned by open_store.
+    - url: The storage integration URL of the device.
+    - headers: HTTP headers for the request.
+    Outputs:
+    - Returns the number of new parsed messages stored.
+    """
+    last_received_at = get_last_received_at(store, url)
+    params = {"after": last_received_at} if last_received_at else None
+    new_count = 0
+    batch = []
+    for line in ttn_data.stream_data(url, headers, params):
+        received_at, parsed_message = ttn_data.decode_storage_line(line)
+        if received_at and (last_received_at is None or received_at_key(received_at) > received_at_key(last_received_at)):
+            last_received_at = received_at
+        if parsed_message:
+            batch.append((url, parsed_message["received_at"], json.dumps(parsed_message)))
+        if len(batch) >= SYNC_BATCH_SIZE:
+            new_count += _store_batch(store, url, batch, last_received_at)
+            batch = []
+    new_count += _store_batch(store, url, batch, last_received_at)
+    return new_count
+
+def _store_batch(store, url, batch, last_received_at):
+    """
+    Insert a batch of parsed messages and the sync position in a single transaction.
+    """
+    with store:
+        before = store.total_changes
+        store.executemany("INSERT OR IGNORE INTO uplinks (url, received_at, message) VALUES (?, ?, ?)", batch)
+        new_count = store.total_changes - before
+        if last_received_at:
+            store.execute("INSERT OR REPLACE INTO sync_state (url, last_received_at) VALUES (?, ?)", (url, last_received_at))
+    return new_count
+
+def append_messages(store, url, messages):
+    """
+    Append parsed messages received outside a sync (e.g. pushed by a webhook) to the store.
+    The sync position is not changed, the messages fetched again by a later sync are ignored.
+    Inputs:
+    - store: Connection returned by open_store.
+    - url: The storage integration URL of the device.
+    - messages: List of parsed message data.
+    Outputs:
+    - Returns the number of new parsed messages stored.
+    """
+    return _store_batch(store, url, [(url, message["received_at"], json.dumps(message)) for message in messages], None)
+
+def iter_parsed_data(store, url, after=None):
+    """
+    Lazily load the parsed messages of a URL from the store, one row at a time.
+    Inputs:
+    - store: Connection returned by open_store.
+    - url: The storage integration URL of the device.
+    - after: Optional parsed 'received_at' string, only the messages received after it are loaded.
+    Outputs:
+    - Yields dictionaries with parsed message data, in chronological order.
+    """
+    if after:
+        rows = store.execute("SELECT message FROM uplinks WHERE url = ? AND received_at > ? ORDER BY received_at", (url, after))
+    else:
+        rows = store.execute("SELECT message FROM uplinks WHERE url = ? ORDER BY received_at", (url,))
+    for row in rows:
+        yield json.loads(row[0])
+
+def load_parsed_data(store, url, after=None):
+    """
+    Load the parsed messages of a URL from the store.
+    Inputs:
+    - store: Connection returned by open_store.
+    - url: The storage integration URL of the device.
+    - after: Optional parsed 'received_at' string, only the messages received after it are loaded.
+    Outputs:
+    - Returns a list of dictionaries with parsed message data, in chronological order.
+    """
+    return list(iter_parsed_data(store, url, after))
+
+def get_parsed_data(connection, path=DEFAULT_STORE_PATH):
+    """
+    Refresh the local store with the new messages and return the whole parsed history.
+    Inputs:
+    - connection: Dictionary containing the TTN URL and headers for authentication.
+    - path: Path of the SQLite database file.
+    Outputs:
+    - Returns a list of dictionaries with parsed message data, in chronological order.
+    """
+    store = open_store(path)
+    try:
+        new_count = sync_store(store, connection["url"], connection["headers"])
+        print("New messages stored:", new_count)
+        return load_parsed_data(store, connection["url"])
+    finally:
+        store.close()
+
+def get_columnar_data(connection, path=DEFAULT_STORE_PATH):
+    """
+    Refresh the local store with the new messages and return the whole history in columnar form.
+    The stored messages are converted row by row, the parsed history is never held as a list of dictionaries.
+    Inputs:
+    - connection: Dictionary containing the TTN URL and headers for authentication.
+    - path: Path of the SQLite database file.
+    Outputs:
+    - Returns the columnar message data (see ttn_data.to_columnar).
+    """
+    store = open_store(path)
+    try:
+        new_count = sync_store(store, connection["url"], connection["headers"])
+        print("New messages stored:", new_count)
+        return ttn_data.to_columnar(iter_parsed_data(store, connection["url"]))
+    finally:
+        store.close()
+
+def main():
+    """
+    Main function to refresh the local message store from TTN.
+    This function syncs the messages of the configured device and prints the store size.
+    """
+    connection = {
+        "url": TTN_URL,
+        "headers": {
+            "Authorization": "Bearer " + ttn_apikey
+        }
+    }
+    columnar = get_columnar_data(connection)
+    print("Stored messages:", len(columnar["received_at"]))
+
+if __name__ == "__main__":
+    main()
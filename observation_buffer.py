@@ -0,0 +1,193 @@
+import fingerprint
+import ttn_data
+import numpy as np
+from collections import deque
+
+# Classifications shared by all the devices located by the process (see fingerprint.new_classification_cache)
+classification_cache = fingerprint.new_classification_cache()
+
+def new_buffer(capacity):
+    """
+    Create an empty sliding-window buffer with the receptions of the latest messages of a device.
+    The buffer keeps prefix sums of the RSSI and of the reception count per (gateway, channel) in a ring, so the
+    observation of any window of the latest messages is obtained with a single subtraction.
+    Inputs:
+    - capacity: Maximum number of messages in a window.
+    Outputs:
+    - Returns a dictionary with the buffer state.
+    """
+    return {
+        "capacity": capacity,
+        "gateway_index": {},
+        # Ring of prefix sums: entry (total % (capacity + 1)) holds the sums after 'total' messages
+        "rssi_sums": np.zeros((capacity + 1, 0, fingerprint.CHANNEL_QTY)),
+        "counts": np.zeros((capacity + 1, 0, fingerprint.CHANNEL_QTY), dtype=np.int64),
+        "total": 0,
+        # First gateway, TX channels used and GPS position of the latest messages, most recent last
+        "messages": deque(maxlen=capacity),
+        "last_gps_total": None,
+        "last_received_at": None
+    }
+
+def _add_gateway(buffer, gateway_id):
+    """
+    Add a gateway column to the prefix sums (no receptions so far) and return its index.
+    """
+    buffer["gateway_index"][gateway_id] = len(buffer["gateway_index"])
+    ring_size = buffer["capacity"] + 1
+    buffer["rssi_sums"] = np.concatenate([buffer["rssi_sums"], np.zeros((ring_size, 1, fingerprint.CHANNEL_QTY))], axis=1)
+    buffer["counts"] = np.concatenate([buffer["counts"], np.zeros((ring_size, 1, fingerprint.CHANNEL_QTY), dtype=np.int64)], axis=1)
+    return buffer["gateway_index"][gateway_id]
+
+def add_message(buffer, message):
+    """
+    Add a parsed message to the buffer, evicting the oldest one when the buffer is full.
+    Inputs:
+    - buffer: Buffer state (see new_buffer).
+    - message: Parsed message data, newer than the ones already added.
+    """
+    ring_size = buffer["capacity"] + 1
+    previous = buffer["total"] % ring_size
+    current = (buffer["total"] + 1) % ring_size
+    rssi_sums = buffer["rssi_sums"][previous].copy()
+    counts = buffer["counts"][previous].copy()
+    channel = message["channel"]
+    first_gateway = None
+    for rx_meta in message["rx_metadata"]:
+        gateway_id = rx_meta["gateway_id"]
+        if first_gateway is None:
+            first_gateway = gateway_id
+        if rx_meta["rssi"] is None or channel is None or not 0 <= channel < fingerprint.CHANNEL_QTY:
+            continue
+        g = buffer["gateway_index"].get(gateway_id)
+        if g is None:
+            g = _add_gateway(buffer, gateway_id)
+            rssi_sums = np.concatenate([rssi_sums, np.zeros((1, fingerprint.CHANNEL_QTY))])
+            counts = np.concatenate([counts, np.zeros((1, fingerprint.CHANNEL_QTY), dtype=np.int64)])
+        rssi_sums[g, channel] += rx_meta["rssi"]
+        counts[g, channel] += 1
+    # Overwriting the oldest prefix sum evicts the message that leaves the window
+    buffer["rssi_sums"][current] = rssi_sums
+    buffer["counts"][current] = counts
+    buffer["total"] += 1
+    gps_location = message["decoded_payload"].get("gps_3")
+    if gps_location is not None:
+        buffer["last_gps_total"] = buffer["total"]
+    buffer["messages"].append((first_gateway, message["decoded_payload"].get("digital_in_5", 0), gps_location))
+
+def _received_at_ns(received_at):
+    """
+    Convert a full precision 'received_at' string into nanoseconds since the Unix epoch, whatever its number of decimals.
+    """
+    return int(np.datetime64(received_at.rstrip("Z"), "ns").astype(np.int64))
+
+def add_new_message(buffer, message):
+    """
+    Add a parsed message to the buffer unless it was not received after the latest one added this way (e.g. a webhook
+    retried by TTN or an uplink arriving out of order), so no message is counted twice.
+    Inputs:
+    - buffer: Buffer state (see new_buffer).
+    - message: Parsed message data.
+    Outputs:
+    - Returns True if the message was added.
+    """
+    if buffer["last_received_at"] and _received_at_ns(message["received_at"]) <= _received_at_ns(buffer["last_received_at"]):
+        return False
+    buffer["last_received_at"] = message["received_at"]
+    add_message(buffer, message)
+    return True
+
+def add_messages(buffer, messages):
+    """
+    Add a list of parsed messages to the buffer.
+    Inputs:
+    - buffer: Buffer state (see new_buffer).
+    - messages: List of parsed message data, in chronological order.
+    """
+    for message in messages:
+        add_message(buffer, message)
+
+def get_observation(buffer, msg_qty):
+    """
+    Get the observation of the latest messages of the buffer.
+    Inputs:
+    - buffer: Buffer state (see new_buffer).
+    - msg_qty: Number of latest messages in the window (at most the buffer capacity).
+    Outputs:
+    - Returns the average RSSI per channel per gateway, the TX channels used in the most recent message and
+      the most recent GPS position of the window (or None). The observation is empty when the buffer is empty.
+    """
+    msg_qty = min(msg_qty, buffer["capacity"], buffer["total"])
+    if msg_qty <= 0:
+        return {}, 0, None
+    ring_size = buffer["capacity"] + 1
+    latest = buffer["total"] % ring_size
+    oldest = (buffer["total"] - msg_qty) % ring_size
+    rssi_sums = buffer["rssi_sums"][latest] - buffer["rssi_sums"][oldest]
+    counts = buffer["counts"][latest] - buffer["counts"][oldest]
+    first_gateway, tx_channels_used, gps_location = buffer["messages"][-1]
+    if buffer["last_gps_total"] is not None and buffer["total"] - buffer["last_gps_total"] < msg_qty:
+        gps_location = buffer["messages"][buffer["last_gps_total"] - buffer["total"] - 1][2]
+    # The first gateway of the most recent message goes first, its channels are used to pad the missing gateways
+    gateways = sorted(buffer["gateway_index"].items(), key=lambda item: (item[0] != first_gateway, item[1]))
+    new_data = {}
+    for gateway_id, g in gateways:
+        channels = np.flatnonzero(counts[g])
+        if len(channels):
+            new_data[gateway_id] = {int(ch): rssi_sums[g, ch] / counts[g, ch] for ch in channels}
+    return new_data, tx_channels_used, gps_location
+
+def sync_buffer(buffer, url, headers, session=None):
+    """
+    Fetch the messages newer than the latest one in the buffer and add them.
+    The first sync fetches the last 'capacity' messages, the next ones skip the messages not received after the latest
+    one in the buffer.
+    Inputs:
+    - buffer: Buffer state (see new_buffer).
+    - url: The storage integration URL of the device.
+    - headers: HTTP headers for the request.
+    - session: Optional requests.Session, the shared ttn_client session by default.
+    Outputs:
+    - Returns the number of new parsed messages added.
+    """
+    if buffer["last_received_at"]:
+        lines = ttn_data.stream_data(url, headers, {"after": buffer["last_received_at"], "order": "received_at"}, session)
+    else:
+        lines = reversed(ttn_data.get_last_n_messages(url, headers, buffer["capacity"], session))
+    last_received_ns = _received_at_ns(buffer["last_received_at"]) if buffer["last_received_at"] else None
+    new_messages = []
+    for line in lines:
+        received_at, parsed_message = ttn_data.decode_storage_line(line)
+        if received_at:
+            received_at_ns = _received_at_ns(received_at)
+            # Messages already in the buffer (e.g. received at the 'after' bound) are skipped
+            if last_received_ns is not None and received_at_ns <= last_received_ns:
+                continue
+            buffer["last_received_at"] = received_at
+            last_received_ns = received_at_ns
+        if parsed_message:
+            new_messages.append(parsed_message)
+    # Only the last 'capacity' messages can be inside a window
+    add_messages(buffer, new_messages[-buffer["capacity"]:])
+    return len(new_messages)
+
+def locate_buffer(fingerprint_map, buffer, msg_qty, consider_tx_channels):
+    """
+    Get the location of a device from the latest messages of its observation buffer.
+    Inputs:
+    - fingerprint_map: Fingerprint of the RSS map (see fingerprint.load_fingerprint).
+    - buffer: Observation buffer of the device (see new_buffer).
+    - msg_qty: Number of latest messages used for the location determination.
+    - consider_tx_channels: Boolean indicating whether to consider previous TX channels.
+    Outputs:
+    - Returns the GPS coordinates (and no error scores) if a message has them, otherwise the classified location and the
+      associated error scores (shared with the classification cache, not to be modified).
+    """
+    # Average RSSI per gateway and channel, TX channels of the most recent message and GPS coord. if available
+    new_data, tx_channels_used, gps_location = get_observation(buffer, msg_qty)
+    if gps_location is not None:
+        return gps_location, {}
+    # Classify new_data, parked devices repeat the same observation and hit the cache
+    if consider_tx_channels:
+        return fingerprint.classify_observation_cached(classification_cache, fingerprint_map, new_data, tx_channels_used)
+    return fingerprint.classify_observation_cached(classification_cache, fingerprint_map, new_data, 0)
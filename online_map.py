@@ -0,0 +1,182 @@
+from secrets_folder.secrets_file import ttn_apikey, TTN_URL
+import message_store
+import fingerprint
+import time_mapping
+import ttn_data
+import numpy as np
+import json
+import time
+import os
+
+PUBLISHED_MAP_PATH = fingerprint.PUBLISHED_MAP_PATH
+MAP_STATE_PATH = os.path.join("maps", "online_map_state.json")
+# Seconds between store refreshes while building the map online
+MAP_UPDATE_PERIOD = 30
+
+def new_map_state(decay=None):
+    """
+    Create an empty online map state.
+    Inputs:
+    - decay: Optional exponential decay factor (0 < decay < 1) applied to the previous samples of a group on every new sample.
+    Outputs:
+    - Returns a dictionary with the running statistics per (place, gateway, channel), the map version and the last processed message.
+    """
+    return {
+        "decay": decay,
+        "version": 0,
+        "last_received_at": None,
+        "stats": {}
+    }
+
+def update_map_state(state, place_name, messages):
+    """
+    Update the running statistics of a place with new labelled messages (weighted Welford algorithm).
+    Inputs:
+    - state: Online map state (see new_map_state).
+    - place_name: Place where the messages were received.
+    - messages: List of parsed message data.
+    Outputs:
+    - Returns the number of receptions added.
+    """
+    decay = state["decay"] if state["decay"] else 1.0
+    added = 0
+    for message in messages:
+        channel = message["channel"]
+        for rx_meta in message["rx_metadata"]:
+            rssi = rx_meta["rssi"]
+            if rssi is None or channel is None:
+                continue
+            key = (place_name, rx_meta["gateway_id"], channel)
+            if key not in state["stats"]:
+                state["stats"][key] = [0, 0.0, 0.0, 0.0]
+            group = state["stats"][key]
+            # [count, weight, mean, m2]
+            group[0] += 1
+            group[1] = decay * group[1] + 1
+            delta = rssi - group[2]
+            group[2] += delta / group[1]
+            group[3] = decay * group[3] + delta * (rssi - group[2])
+            added += 1
+        if state["last_received_at"] is None or message["received_at"] > state["last_received_at"]:
+            state["last_received_at"] = message["received_at"]
+    return added
+
+def map_from_state(state, RSS_NULL):
+    """
+    Build the RSS map and its variance from the running statistics.
+    Inputs:
+    - state: Online map state (see new_map_state).
+    - RSS_NULL: Value used for the channels without samples.
+    Outputs:
+    - Returns the RSS map and the variance map (place -> gateway -> channel -> value).
+    """
+    rss_map = {}
+    rss_var = {}
+    for (place_name, gateway_id, channel), (count, weight, mean, m2) in sorted(state["stats"].items()):
+        if gateway_id not in rss_map.setdefault(place_name, {}):
+            # Fill channels using RSS_NULL
+            rss_map[place_name][gateway_id] = {ch: RSS_NULL for ch in range(8)}
+            rss_var.setdefault(place_name, {})[gateway_id] = {}
+        rss_map[place_name][gateway_id][channel] = mean
+        rss_var[place_name][gateway_id][channel] = m2 / weight
+    return rss_map, rss_var
+
+def label_messages(messages, time_map):
+    """
+    Assign the messages to the places of a time map.
+    Inputs:
+    - messages: List of parsed message data.
+    - time_map: List of time range mappings with associated place names.
+    Outputs:
+    - Returns a dictionary with the list of messages received in each place.
+    """
+    received_at = ttn_data.received_at_to_epoch_us([message["received_at"] for message in messages])
+    place_messages = {}
+    for place in time_map:
+        (begin, end) = place["time_tuple"]
+        inside = np.flatnonzero((ttn_data.datetime_to_epoch_us(begin) <= received_at) & (received_at <= ttn_data.datetime_to_epoch_us(end)))
+        if len(inside):
+            place_messages.setdefault(place["place_name"], []).extend(messages[m] for m in inside)
+    return place_messages
+
+def publish_map(state, RSS_NULL, path=PUBLISHED_MAP_PATH, state_path=MAP_STATE_PATH):
+    """
+    Publish a new version of the map atomically, so readers never see a partially written file.
+    The running statistics are saved next to it to resume the map building after a restart.
+    Inputs:
+    - state: Online map state (see new_map_state), its version is incremented.
+    - RSS_NULL: Value used for the channels without samples.
+    - path: Path of the published binary map file.
+    - state_path: Path of the saved map state.
+    """
+    state["version"] += 1
+    saved_state = {
+        "version": state["version"],
+        "RSS_NULL": RSS_NULL,
+        "decay": state["decay"],
+        "last_received_at": state["last_received_at"],
+        "stats": [list(key) + group for key, group in state["stats"].items()]
+    }
+    if os.path.dirname(state_path):
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    temp_path = state_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(saved_state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, state_path)
+    rss_map, rss_var = map_from_state(state, RSS_NULL)
+    fingerprint.save_map_file(path, rss_map, RSS_NULL, rss_var, state["version"])
+
+def load_map_state(state_path=MAP_STATE_PATH):
+    """
+    Load the saved online map state.
+    Inputs:
+    - state_path: Path of the saved map state.
+    Outputs:
+    - Returns the online map state to resume updating it and its RSS_NULL value.
+    """
+    with open(state_path) as file:
+        saved_state = json.load(file)
+    state = new_map_state(saved_state["decay"])
+    state["version"] = saved_state["version"]
+    state["last_received_at"] = saved_state["last_received_at"]
+    state["stats"] = {(place_name, gateway_id, channel): [count, weight, mean, m2] for place_name, gateway_id, channel, count, weight, mean, m2 in saved_state["stats"]}
+    return state, saved_state["RSS_NULL"]
+
+def main():
+    """
+    Main function to build the RSS map online.
+    This function periodically refreshes the local message store, adds the new messages received inside the
+    time map ranges to the running statistics and publishes a new map version when something changed.
+    """
+    connection = {
+        "url": TTN_URL,
+        "headers": {
+            "Authorization": "Bearer " + ttn_apikey
+        }
+    }
+    RSS_NULL = -110
+    if os.path.exists(MAP_STATE_PATH):
+        state, RSS_NULL = load_map_state()
+        print("Resuming map version", state["version"])
+    else:
+        decay = input("Decay factor (empty for none): ").strip()
+        state = new_map_state(float(decay) if decay else None)
+    time_map = time_mapping.time_map()
+    store = message_store.open_store()
+    while True:
+        message_store.sync_store(store, connection["url"], connection["headers"])
+        messages = message_store.load_parsed_data(store, connection["url"], state["last_received_at"])
+        added = 0
+        for place_name, place_messages in label_messages(messages, time_map).items():
+            added += update_map_state(state, place_name, place_messages)
+        if messages:
+            state["last_received_at"] = messages[-1]["received_at"]
+        if added:
+            publish_map(state, RSS_NULL)
+            print("Published map version", state["version"], "with", added, "new receptions")
+        time.sleep(MAP_UPDATE_PERIOD)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+from datetime import datetime
+import traffic_generator
+import fingerprint
+import ttn_data
+import observation_buffer
+import numpy as np
+import subprocess
+import tracemalloc
+import argparse
+import platform
+import json
+import time
+import os
+
+DEFAULT_RESULTS_PATH = os.path.join("data", "perf")
+SYNTHETIC_RSS_NULL = -110
+
+def measure(function, repeat, warmup=1):
+    """
+    Measure the latency, throughput and peak memory of a function.
+    The timed runs are done without memory tracing, the peak memory is measured on an additional run.
+    Inputs:
+    - function: Function without arguments to measure.
+    - repeat: Number of timed runs.
+    - warmup: Number of untimed runs done first.
+    Outputs:
+    - Returns a dictionary with the runs, the operations per second, the mean, p50 and p99 latencies (ms) and the peak memory (KiB).
+    """
+    for _ in range(warmup):
+        function()
+    latencies = np.empty(repeat)
+    for r in range(repeat):
+        start = time.perf_counter()
+        function()
+        latencies[r] = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "repeat": repeat,
+        "ops_per_s": repeat / latencies.sum(),
+        "mean_ms": 1000 * latencies.mean(),
+        "p50_ms": 1000 * np.percentile(latencies, 50),
+        "p99_ms": 1000 * np.percentile(latencies, 99),
+        "peak_memory_kb": peak_memory / 1024
+    }
+
+def run_perf_benchmark(places, gateways, channels, messages, repeat, seed=0):
+    """
+    Run the performance benchmark of the localization hot path on synthetic data.
+    Inputs:
+    - places: Number of places of the synthetic map.
+    - gateways: Number of gateways.
+    - channels: Number of channels (at most 9).
+    - messages: Number of synthetic uplink messages sent (the ones received by no gateway are lost).
+    - repeat: Number of timed runs of every case.
+    - seed: Seed of the synthetic data.
+    Outputs:
+    - Returns a dictionary with the measures of every case (see measure).
+    """
+    rng = np.random.default_rng(seed)
+    scenario = traffic_generator.new_scenario(1, gateways, places, channels, seed=seed)
+    rss_map = traffic_generator.scenario_map(scenario, SYNTHETIC_RSS_NULL)
+    time_map, lines = traffic_generator.build_time_map(traffic_generator.generate_uplinks(scenario, messages))
+    messages = len(lines)
+    parsed_data = ttn_data.parse_json_data(lines)
+    columnar = ttn_data.to_columnar(parsed_data)
+    time_ranges = [place["time_tuple"] for place in time_map]
+    middle = time_ranges[len(time_ranges) // 2]
+    available_gateways = scenario["gateway_ids"][:3]
+    fingerprint_map = fingerprint.build_fingerprint(rss_map, SYNTHETIC_RSS_NULL, available_gateways)
+    new_data = ttn_data.calculate_channels_avg_rssi(parsed_data[:10])
+    classification_cache = fingerprint.new_classification_cache()
+    window = 10
+    buffer = observation_buffer.new_buffer(window)
+    observation_buffer.add_messages(buffer, parsed_data[:window])
+
+    def locate_uplink():
+        # Random next uplink of the traffic added to the device buffer, then located with the latest messages
+        observation_buffer.add_message(buffer, parsed_data[int(rng.integers(0, messages))])
+        observation_buffer.locate_buffer(fingerprint_map, buffer, window, True)
+
+    cases = {
+        "parse_json_data": lambda: ttn_data.parse_json_data(lines),
+        "to_columnar": lambda: ttn_data.to_columnar(parsed_data),
+        "get_time_range_messages": lambda: ttn_data.get_time_range_messages(parsed_data, *middle),
+        "get_time_range_messages_columnar": lambda: ttn_data.get_time_range_messages(columnar, *middle),
+        "get_time_ranges_messages_columnar": lambda: ttn_data.get_time_ranges_messages(columnar, time_ranges),
+        "calculate_avg_rssi": lambda: ttn_data.calculate_avg_rssi(columnar),
+        "aggregate_rssi": lambda: ttn_data.aggregate_rssi(columnar, time_map),
+        "build_fingerprint": lambda: fingerprint.build_fingerprint(rss_map, SYNTHETIC_RSS_NULL, available_gateways),
+        "classify_observation": lambda: fingerprint.classify_observation(fingerprint_map, new_data, 0),
+        # Repeated observation, every run but the first one is a cache hit
+        "classify_observation_cached": lambda: fingerprint.classify_observation_cached(classification_cache, fingerprint_map, new_data, 0),
+        "locate_buffer": locate_uplink
+    }
+    results = {}
+    for name, function in cases.items():
+        results[name] = measure(function, repeat)
+        print(f"{name}: {results[name]['ops_per_s']:.1f} ops/s, p50 {results[name]['p50_ms']:.3f} ms, "
+              f"p99 {results[name]['p99_ms']:.3f} ms, peak {results[name]['peak_memory_kb']:.0f} KiB")
+    return results
+
+def get_commit():
+    """
+    Get the current git commit of the repository, if available.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(previous, current):
+    """
+    Print the throughput change of every case with respect to previous results.
+    Inputs:
+    - previous: Dictionary of previously saved results.
+    - current: Dictionary of the current results.
+    """
+    print("Compared with", previous.get("commit"), previous["parameters"])
+    for name, measures in current["results"].items():
+        if name in previous["results"]:
+            ratio = measures["ops_per_s"] / previous["results"][name]["ops_per_s"]
+            print(f"{name}: {ratio:.2f}x ops/s, p99 {previous['results'][name]['p99_ms']:.3f} -> {measures['p99_ms']:.3f} ms")
+
+def main():
+    """
+    Main function to run the performance benchmark suite.
+    This function runs every case on synthetic data, saves the results as JSON and optionally compares them with
+    previously saved results.
+    """
+    parser = argparse.ArgumentParser(description="Latency and throughput benchmark of the localization hot path")
+    parser.add_argument("--places", type=int, default=20)
+    parser.add_argument("--gateways", type=int, default=4)
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Path of the JSON results (a new file in data/perf by default)")
+    parser.add_argument("--compare", help="Path of previous JSON results to compare with")
+    args = parser.parse_args()
+    parameters = {"places": args.places, "gateways": args.gateways, "channels": min(args.channels, len(traffic_generator.CHANNEL_FREQUENCIES)),
+                  "messages": args.messages, "repeat": args.repeat, "seed": args.seed}
+    current = {
+        "commit": get_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "json_backend": ttn_data.JSON_BACKEND,
+        "parameters": parameters,
+        "results": run_perf_benchmark(**parameters)
+    }
+    output = args.output or os.path.join(DEFAULT_RESULTS_PATH, f"perf_{current['commit'] or 'nocommit'}_{int(time.time())}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(current, file, indent=2)
+    print("Results saved to", output)
+    if args.compare:
+        with open(args.compare) as file:
+            compare_results(json.load(file), current)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import fingerprint
+import numpy as np
+
+# Places closer than this distance (meters) are adjacent, a device can move between them from one fix to the next
+ADJACENCY_DISTANCE = 15
+# Transition costs (negative log-probabilities) of staying, moving to an adjacent place and jumping anywhere else
+STAY_COST = 0.0
+MOVE_COST = 2.0
+JUMP_COST = 12.0
+# Scale converting the error scores (summed squared errors, dB^2) into emission costs (negative log-likelihoods)
+EMISSION_SCALE = 1 / (2 * fingerprint.DEFAULT_RSS_VARIANCE)
+# Number of latest messages of the fixes fed to the filter, shorter windows give faster fixes and the filter stabilizes them
+FILTER_WINDOW = 3
+# Number of decoded steps kept to trace back the most likely track
+FILTER_HISTORY = 100
+# Adjacency of the places of every map in use (tuple of places -> neighbours, see build_adjacency)
+_adjacency_cache = {}
+
+def build_adjacency(places, coordinates, max_distance=ADJACENCY_DISTANCE):
+    """
+    Build the place adjacency graph from the coordinates of the places.
+    Inputs:
+    - places: List of place names (e.g. the places of a fingerprint).
+    - coordinates: Dictionary with the 'latitude' and 'longitude' of the places (e.g. disca_coord). Places without
+      coordinates have no neighbours.
+    - max_distance: Maximum distance (meters) between adjacent places.
+    Outputs:
+    - Returns the (places x neighbours) array with the indices of the neighbours of every place, padded with the place itself.
+    """
+    positions = fingerprint.place_positions(places, coordinates)
+    located = np.flatnonzero(~np.isnan(positions[:, 0]))
+    neighbours = [[] for _ in places]
+    if len(located):
+        x, y = positions[located].T
+        distances = np.hypot(x[:, np.newaxis] - x[np.newaxis], y[:, np.newaxis] - y[np.newaxis])
+        for i, p in enumerate(located):
+            neighbours[p] = [int(located[j]) for j in np.flatnonzero(distances[i] <= max_distance) if j != i]
+    width = max(1, max(len(place_neighbours) for place_neighbours in neighbours))
+    return np.array([place_neighbours + [p] * (width - len(place_neighbours)) for p, place_neighbours in enumerate(neighbours)], dtype=np.intp)
+
+def new_filter(places, neighbours):
+    """
+    Create the state of the temporal filter of a device.
+    The filter is an incremental Viterbi decoder over the places: every fix adds the emission costs of its error scores
+    to the cheapest way of reaching each place (staying, moving from an adjacent place or jumping from anywhere).
+    Inputs:
+    - places: List of place names, in the order of the error score arrays.
+    - neighbours: Adjacency of the places (see build_adjacency).
+    Outputs:
+    - Returns a dictionary with the filter state.
+    """
+    return {
+        "places": list(places),
+        "neighbours": neighbours,
+        # Cost of the most likely track ending in every place, None before the first fix
+        "costs": None,
+        # Previous place of the most likely track ending in every place, most recent step last
+        "backpointers": []
+    }
+
+def reset_filter(place_filter):
+    """
+    Forget the track of a device (e.g. after a GPS fix or a long silence).
+    Inputs:
+    - place_filter: Filter state (see new_filter).
+    """
+    place_filter["costs"] = None
+    place_filter["backpointers"].clear()
+
+def update_filter(place_filter, error_scores):
+    """
+    Add a fix to the filter, in O(places x neighbours).
+    Inputs:
+    - place_filter: Filter state (see new_filter).
+    - error_scores: Error scores of the fix, as the dictionary returned by fingerprint.classify_observation or an array
+      in the order of the filter places.
+    Outputs:
+    - Returns the place at the end of the most likely track and its cost.
+    """
+    if isinstance(error_scores, dict):
+        error_scores = np.array([error_scores[place] for place in place_filter["places"]])
+    emissions = EMISSION_SCALE * np.asarray(error_scores, dtype=float)
+    costs = place_filter["costs"]
+    if costs is None:
+        costs = emissions
+        backpointer = np.arange(len(emissions))
+    else:
+        neighbours = place_filter["neighbours"]
+        move_costs = costs[neighbours] + MOVE_COST
+        best_neighbours = np.argmin(move_costs, axis=1)
+        best_move_costs = move_costs[np.arange(len(costs)), best_neighbours]
+        jump_from = int(np.argmin(costs))
+        # Cheapest predecessor of every place: itself, its best neighbour or the best place overall
+        candidates = np.stack([costs + STAY_COST, best_move_costs, np.full(len(costs), costs[jump_from] + JUMP_COST)])
+        choice = np.argmin(candidates, axis=0)
+        backpointer = np.choose(choice, [np.arange(len(costs)), neighbours[np.arange(len(costs)), best_neighbours], np.full(len(costs), jump_from)])
+        costs = candidates[choice, np.arange(len(costs))] + emissions
+    # Only the cost differences matter, keep them small
+    costs = costs - costs.min()
+    place_filter["costs"] = costs
+    place_filter["backpointers"].append(backpointer)
+    del place_filter["backpointers"][:-FILTER_HISTORY]
+    best = int(np.argmin(costs))
+    return place_filter["places"][best], costs[best]
+
+def get_filter_track(place_filter, length=FILTER_HISTORY):
+    """
+    Trace back the most likely track of the filter.
+    Inputs:
+    - place_filter: Filter state (see new_filter).
+    - length: Maximum number of steps returned.
+    Outputs:
+    - Returns the list of places of the most likely track, oldest first (empty before the first fix).
+    """
+    if place_filter["costs"] is None:
+        return []
+    p = int(np.argmin(place_filter["costs"]))
+    track = []
+    for backpointer in reversed(place_filter["backpointers"][-length:]):
+        track.append(place_filter["places"][p])
+        p = int(backpointer[p])
+    return track[::-1]
+
+def filter_location(place_filter, fingerprint_map, coordinates, location, error_scores):
+    """
+    Filter the location returned by locate.get_current_location / observation_buffer.locate_buffer.
+    The filter is reset by GPS fixes and rebuilt when the places of the map change.
+    Inputs:
+    - place_filter: Filter state (see new_filter), or None to create it.
+    - fingerprint_map: Fingerprint of the RSS map used for the classification.
+    - coordinates: Dictionary with the coordinates of the places (see build_adjacency).
+    - location: Classified place or GPS coordinates.
+    - error_scores: Error scores of the classification (empty for GPS fixes).
+    Outputs:
+    - Returns the filter state and the filtered location (the GPS coordinates themselves for GPS fixes).
+    """
+    places = tuple(fingerprint_map["places"])
+    if place_filter is None or tuple(place_filter["places"]) != places:
+        # The adjacency only depends on the places, every device filter of the process shares it
+        if places not in _adjacency_cache:
+            _adjacency_cache[places] = build_adjacency(places, coordinates)
+        place_filter = new_filter(places, _adjacency_cache[places])
+    if not error_scores:
+        reset_filter(place_filter)
+        return place_filter, location
+    return place_filter, update_filter(place_filter, error_scores)[0]
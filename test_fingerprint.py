@@ -0,0 +1,74 @@
+import numpy as np
+import fingerprint
+
+# Floors, zones per floor and places per zone of the synthetic building
+FLOOR_QTY = 4
+ZONE_QTY = 5
+ZONE_PLACE_QTY = 8
+# Gateways of the synthetic building
+GATEWAY_QTY = 16
+# Lowest RSSI (dBm) heard by the gateways
+SENSITIVITY = -85
+RSS_NULL = -120
+
+def _synthetic_map(rng):
+    """
+    Build a log-distance path loss fingerprint of a building with zones along a corridor, and get the mean RSSI of
+    every place and gateway.
+    """
+    places, positions = [], []
+    for floor in range(FLOOR_QTY):
+        for zone in range(ZONE_QTY):
+            for i in range(ZONE_PLACE_QTY):
+                places.append(f"{floor}{chr(ord('a') + zone)}{i}")
+                positions.append((zone * 20 + rng.uniform(0, 15), rng.uniform(0, 15), floor * 4.0))
+    positions = np.array(positions)
+    gateway_positions = np.column_stack([rng.uniform(-10, 110, GATEWAY_QTY), rng.uniform(-10, 25, GATEWAY_QTY),
+                                         rng.integers(0, FLOOR_QTY, GATEWAY_QTY) * 4.0])
+    distances = np.linalg.norm(positions[:, np.newaxis] - gateway_positions[np.newaxis], axis=2) + 1
+    floors_between = np.abs(positions[:, np.newaxis, 2] - gateway_positions[np.newaxis, :, 2]) / 4
+    means = -35 - 28 * np.log10(distances) - 12 * floors_between
+    gateways = [f"gateway-{g}" for g in range(GATEWAY_QTY)]
+    rss_map = {place: {gateway: {channel: float(means[p, g] + rng.normal(0, 1)) for channel in range(fingerprint.MAP_CHANNEL_QTY)}
+                       for g, gateway in enumerate(gateways) if means[p, g] > SENSITIVITY}
+               for p, place in enumerate(places)}
+    return fingerprint.build_fingerprint(rss_map, RSS_NULL, gateways), means
+
+def _observations(fp, means, rng, qty):
+    """
+    Draw noisy observations of random places, returning the packed observations and the expected places.
+    """
+    truth = rng.integers(0, len(fp["places"]), qty)
+    observations = []
+    for t in truth:
+        observation = {}
+        for g, gateway in enumerate(fp["gateways"]):
+            rssi = means[t, g] + rng.normal(0, 2)
+            if rssi > SENSITIVITY - 3:
+                observation[gateway] = {channel: float(rssi + rng.normal(0, 1)) for channel in range(3)}
+        observations.append(observation)
+    obs_values, obs_mask = fingerprint.pack_observations(fp, observations, 0)
+    return obs_values, obs_mask, [fp["places"][t] for t in truth]
+
+def test_narrow_beam_matches_flat_classifier():
+    rng = np.random.default_rng(0)
+    fp, means = _synthetic_map(rng)
+    obs_values, obs_mask, expected = _observations(fp, means, rng, 1000)
+    flat, _ = fingerprint.classify_observations(fp, obs_values, obs_mask)
+    hierarchy = fingerprint.build_hierarchy(fp)
+    places, scores = fingerprint.classify_hierarchical(fp, obs_values, obs_mask, hierarchy, floor_beam=1, zone_beam=1)
+    assert places == flat
+    flat_accuracy = np.mean([a == b for a, b in zip(flat, expected)])
+    assert np.mean([a == b for a, b in zip(places, expected)]) == flat_accuracy
+    # The bounds prune most of the places
+    assert np.isfinite(scores).mean() < 0.25
+
+def test_narrow_beam_alone_close_to_flat_classifier():
+    rng = np.random.default_rng(1)
+    fp, means = _synthetic_map(rng)
+    obs_values, obs_mask, expected = _observations(fp, means, rng, 1000)
+    flat, _ = fingerprint.classify_observations(fp, obs_values, obs_mask)
+    places, scores = fingerprint.classify_hierarchical(fp, obs_values, obs_mask, floor_beam=1, zone_beam=1, exact=False)
+    flat_accuracy = np.mean([a == b for a, b in zip(flat, expected)])
+    assert np.mean([a == b for a, b in zip(places, expected)]) >= flat_accuracy - 0.1
+    assert np.isfinite(scores).mean() == 1 / (FLOOR_QTY * ZONE_QTY)
@@ -0,0 +1,138 @@
+from secrets_folder.secrets_file import ttn_apikey, TTN_URL
+# Devices followed by the tracker (device name -> storage integration URL), the single TTN_URL device by default
+try:
+    from secrets_folder.secrets_file import TTN_DEVICES
+except ImportError:
+    TTN_DEVICES = {"device": TTN_URL}
+from maps.disca_coordinates import disca_coord
+import observation_buffer
+import place_filter
+import fingerprint
+import ttn_client
+import requests
+import asyncio
+import time
+
+# Seconds between two location updates of every device
+TRACKER_PERIOD = 5
+# Message windows used to locate each device, all derived from the same observation buffer
+WINDOW_SIZES = (10, 5, place_filter.FILTER_WINDOW)
+# Maximum number of requests in flight (and pooled connections)
+MAX_CONCURRENT_REQUESTS = 16
+
+def new_tracker(devices, available_gateways, headers, window_sizes=WINDOW_SIZES, consider_tx_channels=False):
+    """
+    Create the tracker state.
+    Inputs:
+    - devices: Dictionary with the storage integration URL of every device.
+    - available_gateways: List of gateways available for the classification.
+    - headers: HTTP headers for the requests.
+    - window_sizes: Number of most recent messages used for each location estimate.
+    - consider_tx_channels: Boolean indicating whether to consider previous TX channels.
+    Outputs:
+    - Returns a dictionary with the tracker configuration, the shared session, the observation buffer, the temporal filter
+      and the latest location of every device.
+    """
+    fingerprint_map, map_mtime = fingerprint.load_localization_map(available_gateways)
+    return {
+        "devices": devices,
+        "available_gateways": available_gateways,
+        "headers": headers,
+        "window_sizes": tuple(window_sizes),
+        "consider_tx_channels": consider_tx_channels,
+        "fingerprint_map": fingerprint_map,
+        "map_mtime": map_mtime,
+        "session": ttn_client.open_session(MAX_CONCURRENT_REQUESTS),
+        "buffers": {device_id: observation_buffer.new_buffer(max(window_sizes)) for device_id in devices},
+        "filters": {device_id: None for device_id in devices},
+        "locations": {}
+    }
+
+def locate_windows(fingerprint_map, buffer, window_sizes=WINDOW_SIZES, consider_tx_channels=False):
+    """
+    Locate a device with several message windows taken from the same observation buffer.
+    Inputs:
+    - fingerprint_map: Fingerprint of the RSS map (see fingerprint.load_fingerprint).
+    - buffer: Observation buffer of the device (see observation_buffer.new_buffer).
+    - window_sizes: Number of most recent messages used for each location estimate.
+    - consider_tx_channels: Boolean indicating whether to consider previous TX channels.
+    Outputs:
+    - Returns a dictionary with the location and error scores of every window size (empty without messages).
+    """
+    if not buffer["total"]:
+        return {}
+    return {size: observation_buffer.locate_buffer(fingerprint_map, buffer, size, consider_tx_channels) for size in window_sizes}
+
+async def track_device(tracker, semaphore, device_id):
+    """
+    Fetch the new messages of a device once and locate it with every window size.
+    Inputs:
+    - tracker: Tracker state (see new_tracker).
+    - semaphore: asyncio.Semaphore bounding the requests in flight.
+    - device_id: Name of the device in the tracker devices.
+    Outputs:
+    - Returns the dictionary of locate_windows, with the "filtered" location (see place_filter.filter_location) of the
+      FILTER_WINDOW window when tracked, empty if the request failed.
+    """
+    async with semaphore:
+        try:
+            # requests is blocking, the calls run in worker threads sharing the session pool
+            new_messages = await asyncio.to_thread(observation_buffer.sync_buffer, tracker["buffers"][device_id], tracker["devices"][device_id],
+                                    tracker["headers"], tracker["session"])
+        except requests.exceptions.RequestException as e:
+            print(device_id, "request error:", e)
+            return {}
+    windows = locate_windows(tracker["fingerprint_map"], tracker["buffers"][device_id], tracker["window_sizes"], tracker["consider_tx_channels"])
+    # The filter only advances with new messages, otherwise the same fix would be counted again on every tick
+    if place_filter.FILTER_WINDOW in windows and (new_messages or "filtered" not in tracker["locations"].get(device_id, {})):
+        location, error_scores = windows[place_filter.FILTER_WINDOW]
+        tracker["filters"][device_id], filtered_location = place_filter.filter_location(tracker["filters"][device_id], tracker["fingerprint_map"],
+                                                                                        disca_coord, location, error_scores)
+        windows["filtered"] = (filtered_location, {})
+    elif place_filter.FILTER_WINDOW in windows:
+        windows["filtered"] = tracker["locations"][device_id]["filtered"]
+    return windows
+
+async def track_devices(tracker, period=TRACKER_PERIOD, max_concurrent_requests=MAX_CONCURRENT_REQUESTS):
+    """
+    Locate every device of the tracker concurrently, once per period, until cancelled.
+    Inputs:
+    - tracker: Tracker state (see new_tracker), its locations are updated on every tick.
+    - period: Seconds between the start of two ticks.
+    - max_concurrent_requests: Maximum number of requests in flight.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    while True:
+        tick_start = time.monotonic()
+        tracker["fingerprint_map"], tracker["map_mtime"] = fingerprint.reload_fingerprint_map(tracker["fingerprint_map"], tracker["map_mtime"],
+                                                                                         tracker["available_gateways"])
+        device_ids = list(tracker["devices"])
+        results = await asyncio.gather(*(track_device(tracker, semaphore, device_id) for device_id in device_ids))
+        for device_id, windows in zip(device_ids, results):
+            if windows:
+                tracker["locations"][device_id] = windows
+                print(device_id, " ".join(f"{size}: {location}" for size, (location, error_scores) in windows.items()))
+        cache = observation_buffer.classification_cache
+        print(f"Classification cache: {cache['hits']} hits, {cache['misses']} misses")
+        await asyncio.sleep(max(0, period - (time.monotonic() - tick_start)))
+
+def main():
+    """
+    Main function to run the multi-device location tracker.
+    This function follows every device configured in TTN_DEVICES, printing their location every TRACKER_PERIOD seconds.
+    """
+    headers = {
+        "Authorization": "Bearer " + ttn_apikey
+    }
+    available_gateways = ["rak7248-grc-pm65","main-gtw-grc","itaca-upv-022"]
+    tracker = new_tracker(TTN_DEVICES, available_gateways, headers)
+    print("Tracking", len(TTN_DEVICES), "devices")
+    try:
+        asyncio.run(track_devices(tracker))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tracker["session"].close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+import ttn_client
+import numpy as np
+import argparse
+import bisect
+import heapq
+import json
+import time
+
+# Frequency (Hz) of every EU868 channel number, see ttn_data.get_channel
+CHANNEL_FREQUENCIES = ["868100000", "868300000", "868500000", "867100000", "867300000", "867500000", "867700000", "867900000", "868800000"]
+# Weakest RSSI received by a gateway
+GATEWAY_SENSITIVITY = -125
+APPLICATION_ID = "synthetic-app"
+# Coordinates around which the places of the scenario are laid out
+BASE_COORDINATES = (39.4827, -0.3471)
+STORAGE_PATH = "/api/v3/as/applications/{application_id}/devices/{device_id}/packages/storage/uplink_message"
+
+def new_scenario(devices, gateways, places, channels=len(CHANNEL_FREQUENCIES), rssi_std=(2, 6), dropout=0.1,
+                 gps_probability=0.01, dwell=(20, 60), period=(1, 5), seed=0):
+    """
+    Create a synthetic deployment: devices moving between places and receiving gateways.
+    The RSSI of every (place, gateway, channel) follows a normal distribution, the arrays of the returned dictionary
+    can be edited to configure specific places.
+    Inputs:
+    - devices: Number of devices.
+    - gateways: Number of gateways.
+    - places: Number of places.
+    - channels: Number of channels used by the devices (the first ones of CHANNEL_FREQUENCIES).
+    - rssi_std: (min, max) range of the RSSI standard deviation of every place.
+    - dropout: Probability that a gateway in range misses an uplink.
+    - gps_probability: Probability that an uplink carries a GPS (gps_3) fix.
+    - dwell: (min, max) number of uplinks sent by a device in a place before moving.
+    - period: (min, max) seconds between two uplinks of a device.
+    - seed: Seed of the scenario and its traffic.
+    Outputs:
+    - Returns a dictionary with the scenario parameters, names and distributions.
+    """
+    rng = np.random.default_rng(seed)
+    rssi_means = rng.uniform(-120, -60, (places, gateways, 1)) + rng.normal(0, 1.5, (places, gateways, channels))
+    return {
+        "device_ids": [f"dev-{d:05d}" for d in range(devices)],
+        "gateway_ids": [f"gw-{g:03d}" for g in range(gateways)],
+        "place_names": [f"p{p:04d}" for p in range(places)],
+        "channels": channels,
+        "rssi_means": rssi_means,
+        "rssi_std": rng.uniform(rssi_std[0], rssi_std[1], places),
+        # Gateways far away (weak mean RSSI) miss more uplinks
+        "receive_probability": np.clip((rssi_means.mean(axis=2) - GATEWAY_SENSITIVITY) / 40, 0, 1) * (1 - dropout),
+        "coordinates": np.array(BASE_COORDINATES) + rng.uniform(-0.002, 0.002, (places, 2)),
+        "gps_probability": gps_probability,
+        "dwell": dwell,
+        "period": period,
+        "seed": seed
+    }
+
+def scenario_map(scenario, RSS_NULL=-110):
+    """
+    Build the RSS map of the true mean RSSI of a scenario.
+    Inputs:
+    - scenario: Dictionary returned by new_scenario.
+    - RSS_NULL: Value used for the gateways that are not heard in a place.
+    Outputs:
+    - Returns the RSS map (place -> gateway -> channel -> RSSI) of the gateways receiving at least half of the uplinks.
+    """
+    rss_map = {}
+    for p, place_name in enumerate(scenario["place_names"]):
+        rss_map[place_name] = {}
+        for g, gateway_id in enumerate(scenario["gateway_ids"]):
+            if scenario["receive_probability"][p, g] >= 0.5:
+                rss_map[place_name][gateway_id] = {ch: round(float(scenario["rssi_means"][p, g, ch]), 2) for ch in range(scenario["channels"])}
+        if not rss_map[place_name]:
+            rss_map[place_name][scenario["gateway_ids"][0]] = {ch: RSS_NULL for ch in range(scenario["channels"])}
+    return rss_map
+
+def generate_uplinks(scenario, messages, start=datetime(2024, 6, 10, 10, 0)):
+    """
+    Generate the uplinks of all the devices of a scenario in chronological order, without keeping them in memory.
+    Uplinks not received by any gateway are lost, as in the real network.
+    Inputs:
+    - scenario: Dictionary returned by new_scenario.
+    - messages: Number of uplinks sent by every device.
+    - start: Time of the first uplinks.
+    Outputs:
+    - Yields the device id, the place name and the uplink result (webhook payload, or "result" of a storage line).
+    """
+    rng = np.random.default_rng(scenario["seed"] + 1)
+    places = len(scenario["place_names"])
+    gateways = len(scenario["gateway_ids"])
+    devices = []
+    queue = []
+    for d, device_id in enumerate(scenario["device_ids"]):
+        devices.append({"sent": 0, "place": int(rng.integers(0, places)), "stay": int(rng.integers(*scenario["dwell"])),
+                        "tx_channels": [], "battery": 4.2})
+        queue.append((start + timedelta(seconds=float(rng.uniform(0, scenario["period"][1]))), d))
+    heapq.heapify(queue)
+    while queue:
+        received_at, d = heapq.heappop(queue)
+        device = devices[d]
+        device["sent"] += 1
+        if device["sent"] < messages:
+            heapq.heappush(queue, (received_at + timedelta(seconds=float(rng.uniform(*scenario["period"]))), d))
+        device["stay"] -= 1
+        if device["stay"] <= 0:
+            device["place"] = int(rng.integers(0, places))
+            device["stay"] = int(rng.integers(*scenario["dwell"]))
+        p = device["place"]
+        channel = int(rng.integers(0, scenario["channels"]))
+        device["tx_channels"] = (device["tx_channels"] + [channel])[-8:]
+        device["battery"] = max(3.3, device["battery"] - 1e-5)
+        rssi = np.round(scenario["rssi_means"][p, :, channel] + rng.normal(0, scenario["rssi_std"][p], gateways)).astype(int)
+        received = np.flatnonzero((rng.random(gateways) < scenario["receive_probability"][p]) & (rssi >= GATEWAY_SENSITIVITY))
+        if not len(received):
+            continue
+        decoded_payload = {
+            "digital_in_4": 1,
+            "digital_in_5": sum(1 << ch for ch in set(device["tx_channels"]) if ch < 8),
+            "analog_in_8": round(device["battery"], 2)
+        }
+        if rng.random() < scenario["gps_probability"]:
+            latitude, longitude = scenario["coordinates"][p] + rng.normal(0, 2e-5, 2)
+            decoded_payload["gps_3"] = {"latitude": round(latitude, 6), "longitude": round(longitude, 6), "altitude": 10.0}
+            decoded_payload["digital_in_4"] = 0
+        received_at_str = received_at.strftime("%Y-%m-%dT%H:%M:%S.%f") + f"{int(rng.integers(0, 1000)):03d}Z"
+        yield scenario["device_ids"][d], scenario["place_names"][p], {
+            "end_device_ids": {"device_id": scenario["device_ids"][d], "application_ids": {"application_id": APPLICATION_ID}},
+            "received_at": received_at_str,
+            "uplink_message": {
+                "f_port": 1,
+                "decoded_payload": decoded_payload,
+                "rx_metadata": [{"gateway_ids": {"gateway_id": scenario["gateway_ids"][g], "eui": f"{g:016X}"},
+                                 "rssi": int(rssi[g]), "channel_rssi": int(rssi[g]), "snr": round(float(rng.uniform(-10, 10)), 1)}
+                                for g in received],
+                "settings": {"frequency": CHANNEL_FREQUENCIES[channel]},
+                "received_at": received_at_str
+            }
+        }
+
+def build_time_map(uplinks):
+    """
+    Build the time map of the places visited by a device, consuming its labelled uplinks.
+    Inputs:
+    - uplinks: Iterable of (device id, place name, uplink result) of a single device, in chronological order.
+    Outputs:
+    - Returns the list of time range mappings (one per visit) with associated place names, and the storage lines (bytes).
+    """
+    time_map = []
+    lines = []
+    for device_id, place_name, result in uplinks:
+        received_at = datetime.strptime(result["received_at"][:26], "%Y-%m-%dT%H:%M:%S.%f")
+        if time_map and time_map[-1]["place_name"] == place_name:
+            time_map[-1]["time_tuple"] = (time_map[-1]["time_tuple"][0], received_at)
+        else:
+            time_map.append({"place_name": place_name, "time_tuple": (received_at, received_at)})
+        lines.append(json.dumps({"result": result}).encode())
+    return time_map, lines
+
+def write_storage_ndjson(path, uplinks, time_map_path=None):
+    """
+    Stream uplinks to a storage integration NDJSON file (one {"result": ...} line per uplink).
+    Inputs:
+    - path: Path of the NDJSON file.
+    - uplinks: Iterable of (device id, place name, uplink result), e.g. generate_uplinks.
+    - time_map_path: Optional path of an NDJSON file receiving the visits (device, place and begin/end received_at).
+    Outputs:
+    - Returns the number of lines and bytes written.
+    """
+    line_count = 0
+    byte_count = 0
+    visits = {}
+    time_map_file = open(time_map_path, "w") if time_map_path else None
+    try:
+        with open(path, "wb", buffering=1 << 20) as file:
+            for device_id, place_name, result in uplinks:
+                line = json.dumps({"result": result}).encode() + b"\n"
+                file.write(line)
+                line_count += 1
+                byte_count += len(line)
+                if time_map_file:
+                    visit = visits.get(device_id)
+                    if visit and visit["place_name"] == place_name:
+                        visit["end"] = result["received_at"]
+                    else:
+                        if visit:
+                            time_map_file.write(json.dumps(visit) + "\n")
+                        visits[device_id] = {"device": device_id, "place_name": place_name, "begin": result["received_at"], "end": result["received_at"]}
+            if time_map_file:
+                for visit in visits.values():
+                    time_map_file.write(json.dumps(visit) + "\n")
+    finally:
+        if time_map_file:
+            time_map_file.close()
+    return line_count, byte_count
+
+def index_storage_ndjson(path):
+    """
+    Index a storage NDJSON file by device, without loading the messages.
+    Inputs:
+    - path: Path of the NDJSON file, in chronological order.
+    Outputs:
+    - Returns a dictionary with the 'received_at' list and the (offset, length) array of the lines of every device.
+    """
+    index = {}
+    offset = 0
+    with open(path, "rb") as file:
+        for line in file:
+            result = json.loads(line)["result"]
+            device_id = result["end_device_ids"]["device_id"]
+            if device_id not in index:
+                index[device_id] = {"received_at": [], "lines": []}
+            index[device_id]["received_at"].append(result["received_at"])
+            index[device_id]["lines"].append((offset, len(line)))
+            offset += len(line)
+    for device_index in index.values():
+        device_index["lines"] = np.array(device_index["lines"], dtype=np.int64).reshape(-1, 2)
+    return index
+
+def serve_storage(path, host="127.0.0.1", port=8080):
+    """
+    Serve a storage NDJSON file with a local stand-in of the TTN storage integration API.
+    The device uplink endpoint supports the 'limit', 'order' (received_at or -received_at), 'after' and 'before' parameters.
+    Inputs:
+    - path: Path of the NDJSON file written by write_storage_ndjson.
+    - host: Host address to listen on.
+    - port: Port to listen on.
+    """
+    index = index_storage_ndjson(path)
+    prefix, _, suffix = STORAGE_PATH.partition("{device_id}")
+
+    class StorageHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            device_id = url.path[len(prefix.format(application_id=APPLICATION_ID)):-len(suffix)] if url.path.endswith(suffix) else None
+            if device_id not in index:
+                self.send_error(404)
+                return
+            params = parse_qs(url.query)
+            received_at = index[device_id]["received_at"]
+            begin = bisect.bisect_right(received_at, params["after"][0]) if "after" in params else 0
+            end = bisect.bisect_left(received_at, params["before"][0]) if "before" in params else len(received_at)
+            lines = index[device_id]["lines"][begin:end]
+            if params.get("order") == ["-received_at"]:
+                lines = lines[::-1]
+            if "limit" in params:
+                lines = lines[:int(params["limit"][0])]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Content-Length", str(int(lines[:, 1].sum())))
+            self.end_headers()
+            with open(path, "rb") as file:
+                for offset, length in lines:
+                    file.seek(offset)
+                    self.wfile.write(file.read(length))
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StorageHandler)
+    print("Serving", sum(len(device_index["received_at"]) for device_index in index.values()), "uplinks of", len(index), "devices")
+    print("Device URL:", f"http://{host}:{port}" + STORAGE_PATH.format(application_id=APPLICATION_ID, device_id="<device-id>"))
+    server.serve_forever()
+
+def post_webhooks(url, uplinks, rate=None, secret=None):
+    """
+    Send uplinks to a webhook endpoint (e.g. the web app /uplink) as TTN would.
+    Inputs:
+    - url: URL of the webhook endpoint.
+    - uplinks: Iterable of (device id, place name, uplink result), e.g. generate_uplinks.
+    - rate: Optional maximum number of uplinks per second.
+    - secret: Optional value of the 'X-Webhook-Secret' header.
+    Outputs:
+    - Returns the number of uplinks sent and of failed requests.
+    """
+    headers = {"X-Webhook-Secret": secret} if secret else {}
+    sent = 0
+    failed = 0
+    start = time.monotonic()
+    for device_id, place_name, result in uplinks:
+        if rate:
+            time.sleep(max(0, start + sent / rate - time.monotonic()))
+        response = ttn_client.post(url, json=result, headers=headers)
+        sent += 1
+        if response.status_code != 200:
+            failed += 1
+    return sent, failed
+
+def main():
+    """
+    Main function of the synthetic TTN traffic generator.
+    This function writes storage NDJSON files, serves them with a local storage API stand-in, or replays the uplinks
+    to a webhook endpoint.
+    """
+    parser = argparse.ArgumentParser(description="Synthetic TTN traffic generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ["generate", "webhook"]:
+        subparser = commands.add_parser(command)
+        subparser.add_argument("--devices", type=int, default=10)
+        subparser.add_argument("--gateways", type=int, default=4)
+        subparser.add_argument("--places", type=int, default=20)
+        subparser.add_argument("--messages", type=int, default=1000, help="Uplinks sent by every device")
+        subparser.add_argument("--dropout", type=float, default=0.1)
+        subparser.add_argument("--gps", type=float, default=0.01, help="Probability of a GPS fix per uplink")
+        subparser.add_argument("--seed", type=int, default=0)
+    commands.choices["generate"].add_argument("--output", default="synthetic_uplinks.ndjson")
+    commands.choices["generate"].add_argument("--time-map", help="Path of the NDJSON file with the visits of every device")
+    commands.choices["webhook"].add_argument("--url", default="http://127.0.0.1:5000/uplink")
+    commands.choices["webhook"].add_argument("--rate", type=float, help="Maximum uplinks per second")
+    commands.choices["webhook"].add_argument("--secret")
+    serve = commands.add_parser("serve")
+    serve.add_argument("--input", default="synthetic_uplinks.ndjson")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve_storage(args.input, args.host, args.port)
+        return
+    scenario = new_scenario(args.devices, args.gateways, args.places, dropout=args.dropout, gps_probability=args.gps, seed=args.seed)
+    uplinks = generate_uplinks(scenario, args.messages)
+    if args.command == "generate":
+        line_count, byte_count = write_storage_ndjson(args.output, uplinks, args.time_map)
+        print("Written", line_count, "uplinks,", byte_count, "bytes to", args.output)
+    else:
+        sent, failed = post_webhooks(args.url, uplinks, args.rate, args.secret)
+        print("Sent", sent, "uplinks,", failed, "failed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import requests
+import threading
+import random
+import time
+
+# Seconds to establish a connection and to wait for the server between two bytes of the response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+# Retries after the first attempt, with exponential backoff (full jitter) capped at BACKOFF_MAX seconds
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# Maximum number of pooled (keep-alive) connections per host
+POOL_SIZE = 16
+# Responses worth retrying: rate limited or temporarily unavailable server
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+def open_session(pool_size=POOL_SIZE):
+    """
+    Open an HTTP session keeping its connections alive in a pool.
+    Inputs:
+    - pool_size: Maximum number of pooled connections per host.
+    Outputs:
+    - Returns the requests.Session.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session():
+    """
+    Get the session shared by all the tools of the process, opening it on first use.
+    Outputs:
+    - Returns the shared requests.Session.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = open_session()
+        return _session
+
+def retry_after_seconds(response):
+    """
+    Get the delay requested by the server in the 'Retry-After' header of a response.
+    Inputs:
+    - response: The requests.Response.
+    Outputs:
+    - Returns the delay in seconds, or None if the header is missing or invalid.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_seconds(attempt):
+    """
+    Get the jittered exponential backoff delay before a retry.
+    Inputs:
+    - attempt: Number of the failed attempt (0 for the first one).
+    Outputs:
+    - Returns a random delay between 0 and the capped exponential backoff, in seconds.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def request(method, url, session=None, timeout=None, max_retries=MAX_RETRIES, **kwargs):
+    """
+    Send an HTTP request through a pooled session, retrying the transient failures.
+    Rate limited and unavailable responses are retried waiting for their 'Retry-After' delay when present, otherwise with
+    a jittered exponential backoff. Idempotent methods (GET, HEAD) are also retried on connection errors and timeouts,
+    while the other ones (e.g. downlink POSTs) are only retried when the connection could not be established, so a
+    request is never delivered twice.
+    Inputs:
+    - method: HTTP method.
+    - url: The URL of the request.
+    - session: Optional requests.Session, the shared session by default.
+    - timeout: Optional (connect, read) timeout in seconds, (CONNECT_TIMEOUT, READ_TIMEOUT) by default.
+    - max_retries: Maximum number of retries after the first attempt.
+    - kwargs: Other arguments of requests.Session.request (headers, params, data, json, stream...).
+    Outputs:
+    - Returns the requests.Response of the last attempt. Raises the requests exception of the last attempt if it failed.
+    """
+    session = session or get_session()
+    timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    idempotent = method.upper() in ("GET", "HEAD")
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            # A connection that was never established is safe to retry with any method
+            if attempt == max_retries or not (idempotent or isinstance(e, requests.exceptions.ConnectTimeout)):
+                raise
+            time.sleep(backoff_seconds(attempt))
+            continue
+        if response.status_code not in RETRY_STATUS or attempt == max_retries:
+            return response
+        if response.status_code in (500, 502, 504) and not idempotent:
+            return response
+        delay = retry_after_seconds(response)
+        print("HTTP", response.status_code, "retrying:", url)
+        # Release the connection back to the pool before waiting
+        response.close()
+        time.sleep(min(delay, BACKOFF_MAX) if delay is not None else backoff_seconds(attempt))
+
+def get(url, **kwargs):
+    """
+    Send a GET request (see request).
+    """
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    """
+    Send a POST request (see request).
+    """
+    return request("POST", url, **kwargs)
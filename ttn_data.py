@@ -1,10 +1,21 @@
 from secrets_folder.secrets_file import ttn_apikey, TTN_URL
 from scipy.ndimage import gaussian_filter1d
-from scipy.stats import median_abs_deviation
-from datetime import datetime, timezone
-import requests
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Union
+import ttn_client
 import json
 import numpy as np
+# Optional faster JSON backends, the standard library is used when none is installed
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 def fetch_data(url, headers):
     """
@@ -15,24 +26,45 @@ def fetch_data(url, headers):
     Outputs:
     - Returns the response data split into lines if successful, otherwise an empty list.
     """
-    response = requests.get(url, headers=headers)
+    response = ttn_client.get(url, headers=headers)
     if response.status_code == 200:
         return response.text.splitlines()
     else:
         print("Error code:", response.status_code)
         return []
 
-def get_last_n_messages(url, headers, msg_qty):
+def stream_data(url, headers, params=None, session=None):
+    """
+    Stream data line by line from the specified URL with given headers, without buffering the whole response.
+    Inputs:
+    - url: The URL to fetch data from.
+    - headers: HTTP headers for the request.
+    - params: Optional query parameters (e.g. {"after": received_at}).
+    - session: Optional requests.Session, the shared ttn_client session by default.
+    Outputs:
+    - Yields the non-empty response lines if successful, otherwise nothing.
+    """
+    with ttn_client.get(url, headers=headers, params=params, stream=True, session=session) as response:
+        if response.status_code == 200:
+            # Lines are kept as bytes, all the JSON backends decode them directly
+            for line in response.iter_lines():
+                if line:
+                    yield line
+        else:
+            print("Error code:", response.status_code)
+
+def get_last_n_messages(url, headers, msg_qty, session=None):
     """
     Fetch the last 'n' messages from the specified URL with given headers.
     Inputs:
     - url: The URL to fetch data from.
     - headers: HTTP headers for the request.
     - msg_qty: Number of messages to fetch.
+    - session: Optional requests.Session, the shared ttn_client session by default.
     Outputs:
     - Returns the response data split into lines if successful, otherwise an empty list.
     """
-    response = requests.get(url + "?limit=" + str(msg_qty) + "&order=-received_at", headers=headers)
+    response = ttn_client.get(url + "?limit=" + str(msg_qty) + "&order=-received_at", headers=headers, session=session)
     if response.status_code == 200:
         return response.text.splitlines()
     else:
@@ -60,43 +92,264 @@ def get_channel(freq):
     }
     return channel_dict.get(str(freq))
 
+def parse_message(result):
+    """
+    Parse a single TTN uplink result into the structured format.
+    Inputs:
+    - result: Decoded uplink result object (the "result" field of a storage line).
+    Outputs:
+    - Returns a dictionary with the parsed message data, or None if the message has no decoded payload.
+    """
+    received_at = result.get("received_at", {})
+    uplink_message = result.get("uplink_message", {})
+    decoded_payload = uplink_message.get("decoded_payload")
+    rx_metadata_arr = uplink_message.get("rx_metadata", [])
+    frequency = uplink_message.get("settings", {}).get("frequency", {})
+    channel = get_channel(frequency)
+    if decoded_payload:
+        # Create the new message structure
+        return {
+            "received_at": received_at[:26] + "Z", #Shorten microseconds for datetime compatibility
+            "decoded_payload": decoded_payload,
+            "rx_metadata": [{"gateway_id": rx_meta.get("gateway_ids").get("gateway_id"), "eui": rx_meta.get("gateway_ids").get("eui"),"rssi": rx_meta.get("rssi")} for rx_meta in rx_metadata_arr],
+            "frequency": frequency,
+            "channel": channel
+        }
+    return None
+
+if msgspec:
+    # Typed subset of a storage line: the fields not declared here are skipped by the decoder
+    class _GatewayIds(msgspec.Struct):
+        gateway_id: Optional[str] = None
+        eui: Optional[str] = None
+
+    class _RxMetadata(msgspec.Struct):
+        gateway_ids: Optional[_GatewayIds] = None
+        rssi: Union[int, float, None] = None
+
+    class _Settings(msgspec.Struct):
+        frequency: Union[str, int, None] = None
+
+    class _UplinkMessage(msgspec.Struct):
+        decoded_payload: Optional[dict] = None
+        rx_metadata: list[_RxMetadata] = []
+        settings: Optional[_Settings] = None
+
+    class _Result(msgspec.Struct):
+        received_at: Optional[str] = None
+        uplink_message: Optional[_UplinkMessage] = None
+
+    class _StorageLine(msgspec.Struct):
+        result: Optional[_Result] = None
+
+    _storage_line_decoder = msgspec.json.Decoder(_StorageLine)
+    JSON_BACKEND = "msgspec"
+elif orjson:
+    JSON_BACKEND = "orjson"
+else:
+    JSON_BACKEND = "json"
+
+def decode_storage_line(line):
+    """
+    Decode a storage integration NDJSON line with the fastest available JSON backend.
+    Inputs:
+    - line: One line of the response (str or bytes).
+    Outputs:
+    - Returns the full precision 'received_at' string (or None) and the parsed message (None if it has no decoded payload).
+    """
+    if JSON_BACKEND == "msgspec":
+        result = _storage_line_decoder.decode(line).result
+        if result is None:
+            return None, None
+        uplink_message = result.uplink_message
+        if uplink_message is None or not uplink_message.decoded_payload:
+            return result.received_at, None
+        frequency = {}
+        if uplink_message.settings and uplink_message.settings.frequency is not None:
+            frequency = uplink_message.settings.frequency
+        return result.received_at, {
+            "received_at": result.received_at[:26] + "Z", #Shorten microseconds for datetime compatibility
+            "decoded_payload": uplink_message.decoded_payload,
+            "rx_metadata": [{"gateway_id": rx_meta.gateway_ids.gateway_id, "eui": rx_meta.gateway_ids.eui, "rssi": rx_meta.rssi} for rx_meta in uplink_message.rx_metadata],
+            "frequency": frequency,
+            "channel": get_channel(frequency)
+        }
+    result = (orjson.loads(line) if JSON_BACKEND == "orjson" else json.loads(line)).get("result", {})
+    return result.get("received_at"), parse_message(result)
+
+def iter_parse_json_data(json_data):
+    """
+    Lazily parse JSON data into the structured format.
+    Inputs:
+    - json_data: Raw NDJSON response body (str or bytes) or an iterable of its lines.
+    Outputs:
+    - Yields dictionaries with parsed message data, skipping the messages without decoded payload.
+    """
+    if isinstance(json_data, (str, bytes)):
+        json_data = json_data.splitlines()
+    for line in json_data:
+        if line:
+            received_at, parsed_line = decode_storage_line(line)
+            if parsed_line:
+                yield parsed_line
+
 def parse_json_data(json_data):
     """
     Parse JSON data into a structured format.
     Inputs:
-    - json_data: Raw JSON data to parse.
+    - json_data: Raw JSON data to parse (list of lines or the whole response body).
     Outputs:
     - Returns a list of dictionaries with parsed message data.
     """
-    parsed_data = []
-    for line in json_data:
-        parsed_line = json.loads(line)
-        received_at = parsed_line.get("result", {}).get("received_at", {})
-        uplink_message = parsed_line.get("result", {}).get("uplink_message", {})
-        decoded_payload = uplink_message.get("decoded_payload")
-        rx_metadata_arr = uplink_message.get("rx_metadata", [])
-        frequency = uplink_message.get("settings", {}).get("frequency", {})
-        channel = get_channel(frequency)
-        if decoded_payload:
-            # Create the new message structure
-            parsed_line = {
-                "received_at": received_at[:26] + "Z", #Shorten microseconds for datetime compatibility
-                "decoded_payload": decoded_payload,
-                "rx_metadata": [{"gateway_id": rx_meta.get("gateway_ids").get("gateway_id"), "eui": rx_meta.get("gateway_ids").get("eui"),"rssi": rx_meta.get("rssi")} for rx_meta in rx_metadata_arr],
-                "frequency": frequency,
-                "channel": channel
-            }
-            parsed_data.append(parsed_line)        
-    return parsed_data
+    return list(iter_parse_json_data(json_data))
+
+def received_at_to_epoch_us(received_at_list):
+    """
+    Convert parsed 'received_at' strings into epoch timestamps.
+    Inputs:
+    - received_at_list: List of timestamp strings in the format "YYYY-MM-DDTHH:MM:SS.ffffffZ".
+    Outputs:
+    - Returns an int64 array with the timestamps in microseconds since the Unix epoch (UTC).
+    """
+    return np.array([received_at.rstrip("Z") for received_at in received_at_list], dtype="datetime64[us]").astype(np.int64)
+
+def datetime_to_epoch_us(date_time):
+    """
+    Convert a datetime into an epoch timestamp, interpreting it as UTC like get_time_range_messages does.
+    Inputs:
+    - date_time: The datetime to convert.
+    Outputs:
+    - Returns the timestamp in microseconds since the Unix epoch.
+    """
+    return (date_time.replace(tzinfo=timezone.utc) - EPOCH) // timedelta(microseconds=1)
+
+def _flatten_payload(decoded_payload, prefix=""):
+    """
+    Flatten the numeric fields of a decoded payload, joining nested keys with a dot (e.g. "gps_3.latitude").
+    """
+    fields = {}
+    for key, value in decoded_payload.items():
+        if isinstance(value, dict):
+            fields.update(_flatten_payload(value, prefix + key + "."))
+        elif isinstance(value, (int, float)):
+            fields[prefix + key] = value
+    return fields
+
+def to_columnar(parsed_data):
+    """
+    Convert parsed message data into a columnar (struct of arrays) representation.
+    The columns are built incrementally, so an iterator of messages (e.g. iter_parse_json_data or
+    message_store.iter_parsed_data) is converted without holding all the message dictionaries in memory.
+    Inputs:
+    - parsed_data: List or iterable of parsed message data.
+    Outputs:
+    - Returns a dictionary with one entry per message in the message columns ("received_at" as epoch
+      microseconds, "channel" with -1 when unknown, "frequency" and the numeric "payload" fields, NaN when
+      missing) and one entry per reception in the "rx_" columns ("rx_msg" links to the message index minus
+      "msg_start", "rx_gateway" indexes the interned "gateways" list). "rx_channel" repeats the message channel.
+      Messages are sorted by "received_at" so time ranges can be sliced with binary searches.
+    """
+    received_at = []
+    channel = []
+    frequency = []
+    gateway_index = {}
+    gateway_euis = []
+    rx_msg = []
+    rx_gateway = []
+    rx_rssi = []
+    # Messages and values of every payload field, expanded with NaN for the other messages at the end
+    payload_fields = {}
+    m = -1
+    for m, message in enumerate(parsed_data):
+        received_at.append(message["received_at"])
+        channel.append(-1 if message["channel"] is None else message["channel"])
+        frequency.append(int(message["frequency"]) if message["frequency"] else 0)
+        for rx_meta in message["rx_metadata"]:
+            gateway_id = rx_meta.get("gateway_id")
+            if gateway_id not in gateway_index:
+                gateway_index[gateway_id] = len(gateway_index)
+                gateway_euis.append(rx_meta.get("eui"))
+            rx_msg.append(m)
+            rx_gateway.append(gateway_index[gateway_id])
+            rx_rssi.append(np.nan if rx_meta.get("rssi") is None else rx_meta.get("rssi"))
+        for key, value in _flatten_payload(message["decoded_payload"]).items():
+            if key not in payload_fields:
+                payload_fields[key] = ([], [])
+            payload_fields[key][0].append(m)
+            payload_fields[key][1].append(value)
+    message_qty = m + 1
+    received_at = received_at_to_epoch_us(received_at)
+    channel = np.array(channel, dtype=np.int8)
+    frequency = np.array(frequency, dtype=np.int64)
+    payload = {}
+    for key, (messages, values) in payload_fields.items():
+        payload[key] = np.full(message_qty, np.nan)
+        payload[key][messages] = values
+    rx_msg = np.array(rx_msg, dtype=np.int32)
+    rx_gateway = np.array(rx_gateway, dtype=np.int32)
+    rx_rssi = np.array(rx_rssi, dtype=np.float32)
+    order = np.argsort(received_at, kind="stable")
+    if np.any(order != np.arange(message_qty)):
+        received_at = received_at[order]
+        channel = channel[order]
+        frequency = frequency[order]
+        payload = {key: value[order] for key, value in payload.items()}
+        # Renumber the receptions and keep them grouped by message, in the new message order
+        new_index = np.empty(message_qty, dtype=np.int32)
+        new_index[order] = np.arange(message_qty, dtype=np.int32)
+        rx_msg = new_index[rx_msg]
+        rx_order = np.argsort(rx_msg, kind="stable")
+        rx_msg = rx_msg[rx_order]
+        rx_gateway = rx_gateway[rx_order]
+        rx_rssi = rx_rssi[rx_order]
+    return {
+        "received_at": received_at,
+        "channel": channel,
+        "frequency": frequency,
+        "payload": payload,
+        "gateways": list(gateway_index.keys()),
+        "gateway_euis": gateway_euis,
+        "rx_msg": rx_msg,
+        "rx_gateway": rx_gateway,
+        "rx_channel": channel[rx_msg],
+        "rx_rssi": rx_rssi,
+        "msg_start": 0
+    }
+
+def is_columnar(data):
+    """
+    Check whether message data uses the columnar representation (see to_columnar).
+    """
+    return isinstance(data, dict)
+
+def _slice_messages(columnar, begin, end):
+    """
+    Slice the messages [begin, end) of a columnar table (and their receptions) without copying the arrays.
+    """
+    rx_begin, rx_end = np.searchsorted(columnar["rx_msg"], [columnar["msg_start"] + begin, columnar["msg_start"] + end])
+    sliced = {key: columnar[key][begin:end] for key in ("received_at", "channel", "frequency")}
+    sliced["payload"] = {key: value[begin:end] for key, value in columnar["payload"].items()}
+    sliced["gateways"] = columnar["gateways"]
+    sliced["gateway_euis"] = columnar["gateway_euis"]
+    for key in ("rx_msg", "rx_gateway", "rx_channel", "rx_rssi"):
+        sliced[key] = columnar[key][rx_begin:rx_end]
+    sliced["msg_start"] = columnar["msg_start"] + begin
+    return sliced
 
 def calculate_avg_rssi(parsed_data):
     """
     Calculate the average RSSI for each gateway.
     Inputs:
-    - parsed_data: List of parsed message data.
+    - parsed_data: List of parsed message data, or its columnar representation.
     Outputs:
     - Returns a dictionary with average RSSI values per gateway.
     """
+    if is_columnar(parsed_data):
+        valid = ~np.isnan(parsed_data["rx_rssi"])
+        gateway_qty = len(parsed_data["gateways"])
+        rssi_sums = np.bincount(parsed_data["rx_gateway"][valid], weights=parsed_data["rx_rssi"][valid].astype(float), minlength=gateway_qty)
+        rssi_counts = np.bincount(parsed_data["rx_gateway"][valid], minlength=gateway_qty)
+        return {parsed_data["gateways"][g]: rssi_sums[g] / rssi_counts[g] for g in range(gateway_qty) if rssi_counts[g] > 0}
     gateway_rssi_dict = {}
     for item in parsed_data:
         rx_metadata_arr = item.get("rx_metadata", [])
@@ -116,85 +369,162 @@ def calculate_channels_avg_rssi(parsed_data):
     """
     Calculate the average RSSI for each channel of each gateway.
     Inputs:
-    - parsed_data: List of parsed message data.
+    - parsed_data: List of parsed message data, or its columnar representation.
     Outputs:
     - Returns a dictionary with average RSSI values per channel per gateway.
     """
-    gateway_rssi_dict = {}
-    for item in parsed_data:
-        channel = item.get("channel")
-        rx_metadata_arr = item.get("rx_metadata", [])
-        for rx_meta in rx_metadata_arr:
-            gateway_id = rx_meta.get("gateway_id")
-            rssi = rx_meta.get("rssi")
-            if gateway_id not in gateway_rssi_dict:
-                gateway_rssi_dict[gateway_id] = {channel:[rssi]}
-            elif channel not in gateway_rssi_dict[gateway_id].keys():
-                gateway_rssi_dict[gateway_id][channel] = [rssi]
-            else:
-                gateway_rssi_dict[gateway_id][channel].append(rssi)
-    avg_rssi_per_gateway = {}
-    for gateway_id, ch_rssi_map in gateway_rssi_dict.items():
-        avg_rssi_per_channel = {}
-        for ch, rssi_list in ch_rssi_map.items():
-            avg_rssi_per_channel[ch] = sum(rssi_list) / len(rssi_list)
-        avg_rssi_per_gateway[gateway_id] = avg_rssi_per_channel
-    return avg_rssi_per_gateway
+    return rss_maps_from_stats(aggregate_rssi(parsed_data), "mean")[None]
 
 def calculate_channels_gauss_rssi(parsed_data, sigma_mode):
     """
     Calculate the Gaussian-filtered average RSSI for each channel of each gateway.
     Inputs:
-    - parsed_data: List of parsed message data.
+    - parsed_data: List of parsed message data, or its columnar representation.
     - sigma_mode: Mode to determine the sigma value (1 for MAD, 0 for standard deviation).
     Outputs:
     - Returns a dictionary with Gaussian-filtered average RSSI values per channel per gateway.
     """
-    gateway_rssi_dict = {}
-    for item in parsed_data:
-        channel = item.get("channel")
-        rx_metadata_arr = item.get("rx_metadata", [])
-        for rx_meta in rx_metadata_arr:
-            gateway_id = rx_meta.get("gateway_id")
-            rssi = rx_meta.get("rssi")
-            if gateway_id not in gateway_rssi_dict:
-                gateway_rssi_dict[gateway_id] = {channel:[rssi]}
-            elif channel not in gateway_rssi_dict[gateway_id].keys():
-                gateway_rssi_dict[gateway_id][channel] = [rssi]
-            else:
-                gateway_rssi_dict[gateway_id][channel].append(rssi)
-    avg_rssi_per_gateway = {}
-    for gateway_id, ch_rssi_map in gateway_rssi_dict.items():
-        avg_rssi_per_channel = {}
-        for ch, rssi_list in ch_rssi_map.items():
-            if sigma_mode == 1:
-                sigma = median_abs_deviation(rssi_list) / 0.6745
-            else:
-                sigma = np.std(rssi_list)
-            if sigma > 0:
-                gauss_rssi_list = gaussian_filter1d(rssi_list, sigma=sigma)
-                avg_rssi_per_channel[ch] = sum(gauss_rssi_list) / len(gauss_rssi_list)
-            else:
-                avg_rssi_per_channel[ch] = sum(rssi_list) / len(rssi_list)
-        avg_rssi_per_gateway[gateway_id] = avg_rssi_per_channel
-    return avg_rssi_per_gateway
+    return rss_maps_from_stats(aggregate_rssi(parsed_data), "gauss_mad" if sigma_mode == 1 else "gauss_std")[None]
+
+def _segment_median(values, starts, counts):
+    """
+    Compute the median of every contiguous segment of an array.
+    """
+    segment_ids = np.repeat(np.arange(len(starts)), counts)
+    sorted_values = values[np.lexsort((values, segment_ids))]
+    return (sorted_values[starts + (counts - 1) // 2] + sorted_values[starts + counts // 2]) / 2
+
+def aggregate_rssi(parsed_data, time_map=None):
+    """
+    Compute the RSSI statistics of every (place, gateway, channel) group in a single pass.
+    Receptions are grouped with a stable sort and reduced per segment, keeping the message order inside each group.
+    Inputs:
+    - parsed_data: List of parsed message data, or its columnar representation.
+    - time_map: Optional list of time range mappings with associated place names. When omitted all the messages
+      belong to a single place named None.
+    Outputs:
+    - Returns a dictionary with the group columns ("place" indexing "places", "gateway" indexing "gateways",
+      "channel" with -1 when unknown) and one array per statistic: "count", "mean", "std", "median", "mad",
+      "gauss_mad" and "gauss_std" (Gaussian-filtered average using sigma MAD / 0.6745 or standard deviation).
+    """
+    columnar = parsed_data if is_columnar(parsed_data) else to_columnar(parsed_data)
+    if time_map is None:
+        places = [None]
+        rx_index = np.arange(len(columnar["rx_rssi"]))
+        rx_place = np.zeros(len(rx_index), dtype=np.int64)
+    else:
+        # Time ranges with the same place name are merged into one place
+        places = list(dict.fromkeys(place["place_name"] for place in time_map))
+        range_places = [places.index(place["place_name"]) for place in time_map]
+        starts, stops = _time_ranges_bounds(columnar, [place["time_tuple"] for place in time_map])
+        rx_starts = np.searchsorted(columnar["rx_msg"], columnar["msg_start"] + starts)
+        rx_stops = np.searchsorted(columnar["rx_msg"], columnar["msg_start"] + stops)
+        rx_index = np.concatenate([np.arange(rx_start, rx_stop) for rx_start, rx_stop in zip(rx_starts, rx_stops)] + [np.zeros(0, dtype=np.int64)])
+        rx_place = np.repeat(np.array(range_places, dtype=np.int64), rx_stops - rx_starts)
+    gateway_qty = max(1, len(columnar["gateways"]))
+    rssi = columnar["rx_rssi"][rx_index].astype(float)
+    valid = ~np.isnan(rssi)
+    keys = ((rx_place[valid] * gateway_qty + columnar["rx_gateway"][rx_index][valid]) * 16 + columnar["rx_channel"][rx_index][valid] + 1).astype(np.int64)
+    rssi = rssi[valid]
+    # Sort and segment by group key
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    rssi = rssi[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.append(starts, len(keys)))
+    group_keys = keys[starts]
+    if len(keys):
+        mean = np.add.reduceat(rssi, starts) / counts
+        std = np.sqrt(np.add.reduceat((rssi - np.repeat(mean, counts)) ** 2, starts) / counts)
+        median = _segment_median(rssi, starts, counts)
+        mad = _segment_median(np.abs(rssi - np.repeat(median, counts)), starts, counts)
+        integral = np.logical_and.reduceat(rssi % 1 == 0, starts)
+    else:
+        mean = std = median = mad = np.zeros(0)
+        integral = np.zeros(0, dtype=bool)
+    # Gaussian filters run over each group in message order
+    gauss_mad = mean.copy()
+    gauss_std = mean.copy()
+    for s in np.flatnonzero((mad > 0) | (std > 0)):
+        rssi_list = rssi[starts[s]:starts[s] + counts[s]]
+        if integral[s]:
+            # Integer RSSI lists are filtered as integers, like the lists built from the parsed messages
+            rssi_list = rssi_list.astype(np.int64)
+        if mad[s] > 0:
+            gauss_mad[s] = np.mean(gaussian_filter1d(rssi_list, sigma=mad[s] / 0.6745))
+        if std[s] > 0:
+            gauss_std[s] = np.mean(gaussian_filter1d(rssi_list, sigma=std[s]))
+    return {
+        "places": places,
+        "gateways": columnar["gateways"],
+        "place": group_keys // 16 // gateway_qty,
+        "gateway": (group_keys // 16) % gateway_qty,
+        "channel": group_keys % 16 - 1,
+        "count": counts,
+        "mean": mean,
+        "std": std,
+        "median": median,
+        "mad": mad,
+        "gauss_mad": gauss_mad,
+        "gauss_std": gauss_std
+    }
+
+def rss_maps_from_stats(stats, statistic):
+    """
+    Build the per place RSS maps of one statistic computed by aggregate_rssi.
+    Inputs:
+    - stats: Dictionary returned by aggregate_rssi.
+    - statistic: Name of the statistic to use (e.g. "mean", "gauss_mad" or "gauss_std").
+    Outputs:
+    - Returns a dictionary with the RSSI value per channel per gateway of every place.
+    """
+    rss_maps = {place_name: {} for place_name in stats["places"]}
+    for p, g, ch, value in zip(stats["place"].tolist(), stats["gateway"].tolist(), stats["channel"].tolist(), stats[statistic].tolist()):
+        gateway_id = stats["gateways"][g]
+        if gateway_id not in rss_maps[stats["places"][p]]:
+            rss_maps[stats["places"][p]][gateway_id] = {}
+        rss_maps[stats["places"][p]][gateway_id][None if ch == -1 else ch] = value
+    return rss_maps
+
+def _time_ranges_bounds(columnar, time_ranges):
+    """
+    Get the [start, stop) message indices of every (begin, end) time range using binary searches.
+    """
+    begins = np.array([datetime_to_epoch_us(begin) for (begin, end) in time_ranges], dtype=np.int64)
+    ends = np.array([datetime_to_epoch_us(end) for (begin, end) in time_ranges], dtype=np.int64)
+    starts = np.searchsorted(columnar["received_at"], begins, side="left")
+    stops = np.maximum(starts, np.searchsorted(columnar["received_at"], ends, side="right"))
+    return starts, stops
 
 def get_time_range_messages(parsed_data, begin, end):
     """
     Get messages within a specific time range.
     Inputs:
-    - parsed_data: List of parsed message data.
+    - parsed_data: List of parsed message data, or its columnar representation.
     - begin: Start of the time range.
     - end: End of the time range.
     Outputs:
-    - Returns a list of messages within the specified time range.
+    - Returns a list of messages within the specified time range (a columnar slice for columnar input).
+    """
+    return get_time_ranges_messages(parsed_data, [(begin, end)])[0]
+
+def get_time_ranges_messages(parsed_data, time_ranges):
+    """
+    Get the messages within several time ranges, parsing the timestamps only once.
+    Inputs:
+    - parsed_data: List of parsed message data, or its columnar representation.
+    - time_ranges: List of (begin, end) datetime tuples, both ends included.
+    Outputs:
+    - Returns one list of messages per time range (zero-copy columnar slices for columnar input).
     """
-    begin_end_messages = []
-    for message in parsed_data:
-        received_at = datetime.strptime(message["received_at"],"%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
-        if begin.replace(tzinfo=timezone.utc) <= received_at <= end.replace(tzinfo=timezone.utc):
-            begin_end_messages.append(message)
-    return begin_end_messages
+    if is_columnar(parsed_data):
+        starts, stops = _time_ranges_bounds(parsed_data, time_ranges)
+        return [_slice_messages(parsed_data, start, stop) for start, stop in zip(starts, stops)]
+    received_at = received_at_to_epoch_us([message["received_at"] for message in parsed_data])
+    order = np.argsort(received_at, kind="stable")
+    starts, stops = _time_ranges_bounds({"received_at": received_at[order]}, time_ranges)
+    # Keep the original message order inside each range
+    return [[parsed_data[m] for m in np.sort(order[start:stop])] for start, stop in zip(starts, stops)]
 
 def main():
     """
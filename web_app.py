@@ -1,13 +1,195 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 from secrets_folder.secrets_file import ttn_apikey, TTN_URL, DOWNLINK_DEV1_URL, DOWNLINK_DEV2_URL
+# Devices whose state is cached (device name -> storage integration URL), the single TTN_URL device by default
+try:
+    from secrets_folder.secrets_file import TTN_DEVICES
+except ImportError:
+    TTN_DEVICES = {"device": TTN_URL}
+# Value of the 'X-Webhook-Secret' header configured in the TTN webhook, /uplink is disabled when it is not defined
+try:
+    from secrets_folder.secrets_file import WEBHOOK_SECRET
+except ImportError:
+    WEBHOOK_SECRET = None
+from maps.disca_coordinates import disca_coord
+import observation_buffer
+import message_store
+import fingerprint
 import ttn_data
+import ttn_client
 import requests
+from collections import deque
+import threading
+import queue
 import json
-import folium
-import os
+import time
+import hmac
+
+# Seconds between keep-alive comments on idle event streams
+EVENTS_KEEPALIVE = 15
+# Updates queued per client before a slow client starts losing them
+EVENTS_QUEUE_SIZE = 100
+# Fixes kept in the track of every device
+TRACK_LENGTH = 1000
+# Fields of the fixes returned by the location endpoints, in order
+FIX_FIELDS = ["timestamp", "latitude", "longitude", "place"]
+# Number of latest messages used to locate a device when an uplink is pushed
+UPLINK_WINDOW = 5
+# Seconds between two refreshes of the device states by the background poller
+DEVICE_STATE_PERIOD = 10
+# Seconds after which a cached device state is refreshed on request
+DEVICE_STATE_TTL = 30
 
 app = Flask(__name__)
-locations = []
+# Latest location of every device, sent to the clients when they connect
+locations = {}
+# Recent fixes of every device (ring buffers of TRACK_LENGTH fixes)
+tracks = {}
+subscribers = []
+locations_lock = threading.Lock()
+# Latest state of every device (interior flag and last message), shared by all the status requests
+device_states = {}
+device_states_lock = threading.Lock()
+# Monotonic time of the latest fetch attempt of every device state, successful or not
+device_states_checked = {}
+device_states_refresh_lock = threading.Lock()
+device_states_poller = None
+# Webhook ingestion: observation buffer of every device and fingerprint of the map (loaded on the first uplink)
+available_gateways = ["rak7248-grc-pm65","main-gtw-grc","itaca-upv-022"]
+uplink_buffers = {}
+fingerprint_map = None
+map_mtime = None
+uplink_lock = threading.Lock()
+
+def publish_location(location):
+    """
+    Store the latest location of a device, append it to the device track and push it to every connected event stream.
+    Inputs:
+    - location: Dictionary with the device, latitude, longitude, place and timestamp of the update.
+    """
+    event = "data: " + json.dumps(location) + "\n\n"
+    with locations_lock:
+        locations[location["device"]] = location
+        if location["device"] not in tracks:
+            tracks[location["device"]] = deque(maxlen=TRACK_LENGTH)
+        tracks[location["device"]].append([location[field] for field in FIX_FIELDS])
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass
+
+def update_device_state(device_id, message):
+    """
+    Update the cached state of a device with its most recent message.
+    Inputs:
+    - device_id: Name of the device.
+    - message: Parsed message data. A message without the interior flag keeps the last known flag.
+    """
+    dev_interior = message["decoded_payload"].get("digital_in_4") #1 Interior, 0 Exterior
+    with device_states_lock:
+        if dev_interior is None and device_id in device_states:
+            dev_interior = device_states[device_id]["dev_interior"]
+        device_states[device_id] = {"dev_interior": dev_interior, "received_at": message["received_at"], "updated": time.monotonic()}
+
+def refresh_device_state(device_id):
+    """
+    Fetch the last message of a device from TTN and update its cached state.
+    The last known state is kept when the fetch fails or the device has no messages.
+    Inputs:
+    - device_id: Name of the device in TTN_DEVICES.
+    """
+    headers = {
+        "Authorization": "Bearer " + ttn_apikey
+    }
+    try:
+        json_data = ttn_data.get_last_n_messages(TTN_DEVICES[device_id], headers, 1)
+    except requests.exceptions.RequestException as e:
+        print(device_id, "state refresh error:", e)
+        return
+    finally:
+        with device_states_lock:
+            device_states_checked[device_id] = time.monotonic()
+    last_messages = ttn_data.parse_json_data(json_data)
+    if last_messages:
+        update_device_state(device_id, last_messages[0])
+
+def poll_device_states():
+    """
+    Refresh the state of every device every DEVICE_STATE_PERIOD seconds (background thread).
+    """
+    while True:
+        for device_id in TTN_DEVICES:
+            refresh_device_state(device_id)
+        time.sleep(DEVICE_STATE_PERIOD)
+
+def _device_state_stale(device_id):
+    """
+    Check whether the state of a device is missing or expired and was not fetched within DEVICE_STATE_TTL.
+    """
+    now = time.monotonic()
+    with device_states_lock:
+        state = device_states.get(device_id)
+        if state is not None and now - state["updated"] <= DEVICE_STATE_TTL:
+            return False
+        return now - device_states_checked.get(device_id, -DEVICE_STATE_TTL - 1) > DEVICE_STATE_TTL
+
+def get_device_state(device_id):
+    """
+    Get the cached state of a device, starting the background poller on first use.
+    The state is only fetched on request when it is missing or older than DEVICE_STATE_TTL (e.g. the poller is failing)
+    and was not already tried within DEVICE_STATE_TTL, and concurrent requests wait for a single refresh.
+    Inputs:
+    - device_id: Name of the device in TTN_DEVICES.
+    Outputs:
+    - Returns a dictionary with the "dev_interior" flag (None if unknown), the "received_at" of the last message and
+      the monotonic "updated" time, or None if no state of the device was ever fetched.
+    """
+    global device_states_poller
+    with device_states_lock:
+        if device_states_poller is None:
+            device_states_poller = threading.Thread(target=poll_device_states, daemon=True)
+            device_states_poller.start()
+    if _device_state_stale(device_id):
+        with device_states_refresh_lock:
+            if _device_state_stale(device_id):
+                refresh_device_state(device_id)
+    with device_states_lock:
+        return device_states.get(device_id)
+
+def locate_uplink(device_id, message):
+    """
+    Locate a device from the latest messages of its observation buffer, after a pushed message was added to it.
+    Inputs:
+    - device_id: Name of the device.
+    - message: Parsed message data, the most recent one of the buffer.
+    Outputs:
+    - Returns the location update (device, latitude, longitude, place and timestamp), or None if no map is available
+      or the place has no coordinates.
+    """
+    global fingerprint_map, map_mtime
+    try:
+        if fingerprint_map is None:
+            fingerprint_map, map_mtime = fingerprint.load_localization_map(available_gateways)
+        else:
+            fingerprint_map, map_mtime = fingerprint.reload_fingerprint_map(fingerprint_map, map_mtime, available_gateways)
+    except FileNotFoundError:
+        return None
+    location, error_scores = observation_buffer.locate_buffer(fingerprint_map, uplink_buffers[device_id], UPLINK_WINDOW, False)
+    # Check if location is a GPS coord.
+    place = None
+    if not isinstance(location, dict):
+        place = location
+        location = disca_coord.get(place)
+        if location is None:
+            print(device_id, "located in", place, "which has no coordinates, not published")
+            return None
+    return {
+        "device": device_id,
+        "latitude": location["latitude"],
+        "longitude": location["longitude"],
+        "place": place,
+        "timestamp": int(ttn_data.received_at_to_epoch_us([message["received_at"]])[0]) / 1e6
+    }
 
 @app.route('/')
 def index():
@@ -21,32 +203,120 @@ def index():
 def set_point():
     """
     Set a new point on the map based on the received JSON data.
-    This function receives JSON data via POST request, updates the locations list, and calls map_update to refresh the map.
+    This function receives JSON data via POST request (latitude, longitude and optionally device, place and timestamp)
+    and pushes the update to the connected maps.
     """
     data = request.get_json()
-    locations = [data]
-    map_update(locations)
+    publish_location({
+        "device": data.get("device", "device"),
+        "latitude": data["latitude"],
+        "longitude": data["longitude"],
+        "place": data.get("place"),
+        "timestamp": float(data.get("timestamp", time.time()))
+    })
     return jsonify({'status': 'success'})
 
+@app.route('/uplink', methods=['POST'])
+def uplink():
+    """
+    Receive an uplink pushed by a TTN webhook.
+    This function parses the uplink like the storage integration messages, appends it to the local message store,
+    updates the device state and locates the device immediately, pushing the new location to the connected maps.
+    """
+    if not WEBHOOK_SECRET:
+        return jsonify({'error': 'webhook disabled, WEBHOOK_SECRET is not configured'}), 503
+    if not hmac.compare_digest(request.headers.get('X-Webhook-Secret', ''), WEBHOOK_SECRET):
+        return jsonify({'error': 'unauthorized'}), 401
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'invalid payload'}), 400
+    device_id = data.get("end_device_ids", {}).get("device_id", "device")
+    message = ttn_data.parse_message(data)
+    if message is None:
+        return jsonify({'status': 'ignored'})
+    with uplink_lock:
+        store = message_store.open_store()
+        try:
+            message_store.append_messages(store, TTN_DEVICES.get(device_id, device_id), [message])
+        finally:
+            store.close()
+        if device_id not in uplink_buffers:
+            uplink_buffers[device_id] = observation_buffer.new_buffer(UPLINK_WINDOW)
+        # Webhooks retried by TTN and late uplinks are stored but neither counted again nor used as the latest state
+        if not observation_buffer.add_new_message(uplink_buffers[device_id], message):
+            return jsonify({'status': 'duplicate'})
+        update_device_state(device_id, message)
+        location = locate_uplink(device_id, message)
+    if location:
+        publish_location(location)
+    return jsonify({'status': 'success', 'location': location})
+
+@app.route('/locations', methods=['GET'])
+def get_locations():
+    """
+    Get the latest position of every device.
+    This function returns the fields of the fixes and one fix (list of values in that order) per device.
+    """
+    with locations_lock:
+        latest = {device: [location[field] for field in FIX_FIELDS] for device, location in locations.items()}
+    return jsonify({'fields': FIX_FIELDS, 'devices': latest})
+
+@app.route('/tracks/<device>', methods=['GET'])
+def get_track(device):
+    """
+    Get the recent track of a device.
+    This function returns the fixes of the device, optionally only those with a timestamp between the 'begin' and
+    'end' query parameters (seconds since the epoch), as lists of values in the order of the fields.
+    """
+    begin = request.args.get('begin', type=float)
+    end = request.args.get('end', type=float)
+    with locations_lock:
+        if device not in tracks:
+            return jsonify({'error': 'unknown device'}), 404
+        track = [fix for fix in tracks[device] if (begin is None or fix[0] >= begin) and (end is None or fix[0] <= end)]
+    return jsonify({'device': device, 'fields': FIX_FIELDS, 'track': track})
+
+@app.route('/events', methods=['GET'])
+def events():
+    """
+    Stream the location updates to the client using Server-Sent Events.
+    This function sends the latest location of every device on connection and then every new update, as one JSON
+    object (device, latitude, longitude, place and timestamp) per event.
+    """
+    subscriber = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+    with locations_lock:
+        for location in locations.values():
+            subscriber.put_nowait("data: " + json.dumps(location) + "\n\n")
+        subscribers.append(subscriber)
+
+    def stream():
+        try:
+            while True:
+                try:
+                    yield subscriber.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+        finally:
+            with locations_lock:
+                subscribers.remove(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/gps_status', methods=['GET'])
 def gps_status():
     """
     Get the current GPS status of the device.
-    This function retrieves the last message from the TTN data source and extracts the 'digital_in_4' status to determine if the device is interior or exterior.
+    This function serves the 'digital_in_4' status of the last message of the device (query parameter 'device', the first
+    configured device by default) from the device state cache, to determine if the device is interior or exterior.
+    The status is 'unknown' until a message with the flag has been fetched.
     """
-    connection = {
-        "url": TTN_URL,
-        "headers": {
-            "Authorization": "Bearer " + ttn_apikey
-        }
-    }
-    json_data = ttn_data.get_last_n_messages(connection["url"], connection["headers"], 1)
-    last_messages = ttn_data.parse_json_data(json_data)
-    dev_interior = 1
-    if len(last_messages) > 0:    
-        last_message = last_messages[0]
-        dev_interior = last_message["decoded_payload"]["digital_in_4"] #1 Interior, 0 Exterior
-    return jsonify({'dev_interior': dev_interior})
+    device_id = request.args.get('device', next(iter(TTN_DEVICES)))
+    if device_id not in TTN_DEVICES:
+        return jsonify({'error': 'unknown device'}), 404
+    state = get_device_state(device_id)
+    if state is None or state["dev_interior"] is None:
+        return jsonify({'dev_interior': 'unknown', 'received_at': state["received_at"] if state else None})
+    return jsonify({'dev_interior': state["dev_interior"], 'received_at': state["received_at"]})
 
 @app.route('/gps_enable', methods=['GET'])
 def gps_enable():
@@ -67,8 +337,8 @@ def gps_enable():
             }
         ]
     })
-    requests.request("POST", DOWNLINK_DEV1_URL, headers=headers, data=payload)
-    requests.request("POST", DOWNLINK_DEV2_URL, headers=headers, data=payload)
+    ttn_client.request("POST", DOWNLINK_DEV1_URL, headers=headers, data=payload)
+    ttn_client.request("POST", DOWNLINK_DEV2_URL, headers=headers, data=payload)
     return jsonify({'status': 'GPS_ENABLE_SEND'})
 
 @app.route('/gps_disable', methods=['GET'])
@@ -90,25 +360,9 @@ def gps_disable():
             }
         ]
     })
-    requests.request("POST", DOWNLINK_DEV1_URL, headers=headers, data=payload)
-    requests.request("POST", DOWNLINK_DEV2_URL, headers=headers, data=payload)
+    ttn_client.request("POST", DOWNLINK_DEV1_URL, headers=headers, data=payload)
+    ttn_client.request("POST", DOWNLINK_DEV2_URL, headers=headers, data=payload)
     return jsonify({'status': 'GPS_ENABLE_SEND'})
 
-def map_update(locations):
-    """
-    Update the map with new locations.
-    This function creates a Folium map with markers for each location and saves it as 'mapa.html' in the 'static' directory.
-    """
-    if locations:
-        map = folium.Map(location=[locations[0]['latitude'], locations[0]['longitude']], zoom_start=18)
-
-        for location in locations:
-            folium.Marker(
-                location=[location['latitude'], location['longitude']]
-            ).add_to(map)
-        map.save(os.path.join('static', 'mapa.html'))
-
-map_update(locations)
-
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True, threaded=True)
\ No newline at end of file